@@ -33,7 +33,7 @@
 # - overall freq range: default: (bottom=30Hz, top=4000Hz)
 #     - based on: https://en.wikipedia.org/wiki/Piano_key_frequencies
 
-import traceback,math
+import traceback,math,bisect
 import os,sys,argparse,re,random,time,ipaddress
 import pyshark
 from TlsPadFncs import *
@@ -43,10 +43,17 @@ import hmac,hashlib,base64
 
 # for sorting
 from operator import itemgetter
+import heapq,itertools
+
+# for doing a session's notes in one go
+import numpy
 
 # hacky beeps
 from beeps import *
 
+# .midi output
+from midifile import write_midi
+
 # take file or directory name on command line, default to current dir
 fodname="."
 
@@ -233,66 +240,10 @@ instarr=instarr_2
 
 # Functions
 
-def selector_match(s,sels,sl=""):
-    '''
-    check if TLS session matches selector
-    selector is a (list of) IP prefixes (v4/v6)
-    '''
-    matches=False
-    thesel=""
-    mbranch="0"
-    #smverbose=args.verbose:
-    smverbose=False
-    if smverbose:
-        print("Checking " + str(s.sess_id) +  " vs. Sels="+str(sels)+" type(sels): " + str(type(sels)) + " sl: " + str(sl))
-        print("src: " + s.src + " dst: " + s.dst)
-    if type(sels)==str and sels=='all': 
-        mbranch="1"
-        matches=True
-        thesel="all"
-    elif type(sels)==str and sels=='src' and sl is not None and sl==s.src: 
-        mbranch="2"
-        matches=True
-        matches=True
-        thesel="src"
-    elif type(sels)==str and sels=='dst' and sl is not None and sl==s.dst: 
-        mbranch="3"
-        matches=True
-        thesel="dst"
-    elif type(sels)==list:
-        if sl is not None:
-            if s.src==sl:
-                mbranch="6"
-                matches=True
-                thesel=sl
-            elif s.dst==sl:
-                mbranch="7"
-                matches=True
-                thesel=sl
-        if not matches:
-            for sel in sels:
-                ipsel=ipaddress.ip_network(sel)
-                if smverbose:
-                    print("Inner checking " + s.src + " vs: " + str(ipsel))
-                if ipaddress.ip_address(s.src) in ipsel:
-                    mbranch="4"
-                    matches=True
-                    thesel=s.src
-                if not matches and smverbose:
-                    print("Inner checking " + s.dst + " vs: " + str(ipsel))
-                if not matches and ipaddress.ip_address(s.dst) in ipsel:
-                    mbranch="5"
-                    matches=True
-                    thesel=s.dst
-                if matches:
-                    break
-    if smverbose:
-        print("Checked " + str(s.sess_id) +  " vs. " + str(sels) + " result: " + str(matches) + " " + thesel + " branch:" + mbranch)
-    return matches,thesel
-
-def size2freqdur(size,minsize,maxsize,nsizes,c2s_direction,lowfreq,highfreq):
-    # map a (packet) size into a frequency and duration based on the low 
-    # and high frequecies, 
+def sizes2freqdurs(sizes,minsize,maxsize,nsizes,c2s_direction,lowfreq,highfreq):
+    # map (packet) sizes into frequencies and durations based on the low 
+    # and high frequecies, sizes is a numpy array (e.g. all of a session's
+    # packets in one direction) and we give back arrays
 
     # default is min 100ms and max 1s and is distributed evenly according 
     # to min and max pdu sizes
@@ -300,10 +251,10 @@ def size2freqdur(size,minsize,maxsize,nsizes,c2s_direction,lowfreq,highfreq):
     #linear
     if maxsize-minsize == 0:
         # likely not what's wanted but let's see...
-        normalised=0.5
+        normalised=numpy.full(len(sizes),0.5)
     else:
-        normalised=(size-minsize)/(maxsize-minsize)
-    duration=int(min_note_length+normalised*(max_note_length-min_note_length))
+        normalised=(sizes-minsize)/(maxsize-minsize)
+    duration=numpy.trunc(min_note_length+normalised*(max_note_length-min_note_length)).astype(numpy.int64)
 
     # log reduction - doens't seem to make much difference
     #lmaxsize=math.log2(maxsize)
@@ -331,16 +282,17 @@ def size2freqdur(size,minsize,maxsize,nsizes,c2s_direction,lowfreq,highfreq):
 def find_set(s,session_sets):
     '''
     search for tls_session_set mwith matching IPs
+    sessions are noted in sess_sets as they're grouped so that's
+    just a lookup by sess_id
     '''
     if len(session_sets)==0:
         if args.verbose:
             print("find_set: Empty set of session_sets!")
-    for w in session_sets:
-        for s1 in w.sessions:
-            if s.sess_id==s1.sess_id:
-                #if args.verbose:
-                    #print("find_set picked:"+str(w))
-                return w
+    w=sess_sets.get(s.sess_id)
+    if w is not None:
+        #if args.verbose:
+            #print("find_set picked:"+str(w))
+        return w
     if args.verbose:
         print("find_set picked none!")
     return None
@@ -404,11 +356,36 @@ def freq2num(freq):
     #print("Mapped " + str(freq) + " to " + str(mnum))
     return mnum
 
+def freqs2nums(freqs):
+    '''
+    freq2num for a numpy array of frequencies
+    '''
+    return 12*numpy.trunc(numpy.log2(freqs/440)).astype(numpy.int64)+69
+
+class keytable(dict):
+    '''
+    The size->key table that size2num builds up, we also keep track
+    of the lowest and biggest keys in there so far and the bounds of
+    our note range so we don't need to work those out on every miss
+    '''
+    __slots__ = [
+            'lowest',
+            'biggest',
+            'low_num',
+            'high_num',
+            ]
+    def __init__(self):
+        super().__init__()
+        self.lowest=None
+        self.biggest=None
+        self.low_num=freq2num(lowest_note)
+        self.high_num=freq2num(highest_note)
+
 def size2num(size,righthand,table):
     '''
-    Map sizes to midikeys based on a table we build up from
-    sizes/keys used, with the right hand for c2s and the left
-    hand for s2c packets
+    Map sizes to midikeys based on a table (a keytable) we build
+    up from sizes/keys used, with the right hand for c2s and the
+    left hand for s2c packets
     '''
     notemin=21
     notemax=108
@@ -417,28 +394,46 @@ def size2num(size,righthand,table):
     if len(table) == 0:
         # initialise
         if righthand:
-            table[size]=60 # middle-C
+            lowest=biggest=60 # middle-C
         else:
-            table[size]=60 # B below middle-C
-    lowest=min(table.items(), key=lambda x: x[1])[1]
-    biggest=max(table.items(), key=lambda x: x[1])[1]
+            lowest=biggest=60 # B below middle-C
+    else:
+        lowest=table.lowest
+        biggest=table.biggest
 
-    low_num=freq2num(lowest_note)
-    high_num=freq2num(highest_note)
+    low_num=table.low_num
+    high_num=table.high_num
     # work our way higher on right hand (c2s) and down
     # the keyboard on left hand (s2c) but don't go
     # past the last keys
     if righthand:
         if biggest < high_num: 
-            table[size]=biggest+1
+            key=biggest+1
         else:
-            table[size]=high_num
+            key=high_num
     else:
         if lowest > low_num:
-            table[size]=lowest-1
+            key=lowest-1
         else:
-            table[size]=low_num
-    return table[size]
+            key=low_num
+    table[size]=key
+    if table.lowest is None or key < table.lowest:
+        table.lowest=key
+    if table.biggest is None or key > table.biggest:
+        table.biggest=key
+    return key
+
+def sizes2nums(sizes,righthand,table):
+    '''
+    size2num for numpy arrays of sizes and directions, sizes not yet in
+    table are added in the order they first appear (as if we'd called
+    size2num for each in turn) and then we just look up the lot
+    '''
+    uniq,first,inv=numpy.unique(sizes,return_index=True,return_inverse=True)
+    for ind in numpy.sort(first).tolist():
+        size2num(int(sizes[ind]),bool(righthand[ind]),table)
+    keys=numpy.array([table[size] for size in uniq.tolist()],dtype=numpy.int64)
+    return keys[inv.reshape(-1)]
 
 def instrument(inum,hashedinst):
     if inum >=0 and inum <=127:
@@ -451,55 +446,21 @@ def instrument(inum,hashedinst):
     print("Error: bad instrument number: " + str(inum) + " on channel: " + str(channel))
     return "ERROR"
 
-def killsilence(array, mingap):
-    '''
-    array has notes:
-        [track,on/off-time,on/off-string,channel,notenum,",81"]
-    - we want to eliminate any no-change periods >limit ms long by
-    reducing the times accordingly
-    - that zaps both silences and over-long notes, but good enough
-    '''
-    time2remove=0
-    lasttime=0
-    for note in array:
-        note[1]-=time2remove
-        #print("outer: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-        wasinner=False
-        while (lasttime+mingap)<note[1]:
-            note[1]-=mingap
-            time2remove+=mingap
-            #print("inner: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            wasinner=True
-
-        lasttime=note[1]
-        if wasinner:
-            #print("innerX note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            pass
-    return
-
 # scale time oddly...
-def scaletime(x):
+def scaletimes(xs):
     '''
     We'll assume original is ~30s or less (before supression)
     and we'll map down to ~10s, with 1st second expanded to
     2.5s, 2nd linear, 3rd 0.75 and the rest to 0.4
+    xs is a numpy array of times, we give back an array
     '''
-    mapped=0
-    if x < 0:
-        raise ValueError(sys.argv[0] + ': negative X in scaletime - ' + str(x) + ' - exiting')
-    elif x <= 1000:
-        mapped=int(2.5*x)
-        #print("Mapped1: "+str(x)+" to: "+str(mapped)) 
-    elif x <= 2000:
-        mapped=int((x-1000)+2500)
-        #print("Mapped2: "+str(x)+" to: "+str(mapped)) 
-    elif x <= 3000:
-        mapped=int((x-2000)*0.75+3500)
-        #print("Mapped3: "+str(x)+" to: "+str(mapped)) 
-    else: 
-        mapped=int((x-3000)*0.4+4250)
-        #print("Mapped4: "+str(x)+" to: "+str(mapped)) 
-    return mapped
+    if numpy.any(xs < 0):
+        raise ValueError(sys.argv[0] + ': negative X in scaletime - ' + str(xs[xs<0][0]) + ' - exiting')
+    mapped=numpy.select(
+            [ xs <= 1000, xs <= 2000, xs <= 3000 ],
+            [ 2.5*xs, (xs-1000)+2500, (xs-2000)*0.75+3500 ],
+            (xs-3000)*0.4+4250)
+    return numpy.trunc(mapped).astype(numpy.int64)
 
 # eliminate cases where the same note is hit whilst already "on" by moving 
 # go through notes array, note who's turned on/off when, then if an on-note is to
@@ -520,7 +481,20 @@ def avoid2keypresses(midicsv):
     if a2kpverbose:
         print("\nentering a2kp, low: " + str(low_num) + " high: " + str(high_num))
         print(str(keys))
-    for line in midicsv:
+    # index things up front so we don't scan the array per collision:
+    # where each track's lines end, where note-on lines with the same
+    # content are (we want the first of those) and where each track's
+    # note-offs for each key are, those last two get updated as we re-key
+    track_end={}
+    ons={}
+    offs={}
+    for ind,line in enumerate(midicsv):
+        track_end[line[0]]=ind+1
+        if line[2]==',note_on_c,':
+            ons.setdefault(tuple(line),[]).append(ind)
+        elif line[2]==',note_off_c,':
+            offs.setdefault((line[0],line[4]),[]).append(ind)
+    for thisline,line in enumerate(midicsv):
         if a2kpverbose:
             print("line" + str(line))
         if channelno!=line[0]:
@@ -557,66 +531,69 @@ def avoid2keypresses(midicsv):
                 if a2kpverbose:
                     print("no new volume setting ("+str(svel)+"<="+str(maxvel)+"-"+str(velinc)+") for " + str(line))
             '''
-            thisind=midicsv.index(line)
-            last=len(midicsv)
+            # first line that looks like this one
+            thisind=ons[tuple(line)][0]
             fixed=False
-            for ind in range(thisind,last):
-                offset=1
-                off_increment=2 
-                newkeynum=keynum+offset
-                updir=True
-                finishedup=False
-                finisheddown=False
-                nonewkey=False
-                while newkeynum>=low_num and newkeynum<=high_num and keys[newkeynum]==True:
-                    if not finishedup and updir:
-                        offset=abs(offset)
-                        if finisheddown:
-                            offset=offset+off_increment
-                        if not finisheddown:
-                            updir=False
-                    elif not finisheddown: 
-                        if not finishedup:
-                            offset=offset+off_increment
-                            offset=-1*offset
-                            updir=True
-                        else:
-                            offset=offset-off_increment
-                    newkeynum=keynum+offset
-                    if newkeynum>=high_num:
-                        if a2kpverbose:
-                            print("re-keying finishedup")
-                        finishedup=True
+            offset=1
+            off_increment=2 
+            newkeynum=keynum+offset
+            updir=True
+            finishedup=False
+            finisheddown=False
+            nonewkey=False
+            while newkeynum>=low_num and newkeynum<=high_num and keys[newkeynum]==True:
+                if not finishedup and updir:
+                    offset=abs(offset)
+                    if finisheddown:
+                        offset=offset+off_increment
+                    if not finisheddown:
                         updir=False
-                    if newkeynum<=low_num:
-                        if a2kpverbose:
-                            print("re-keying finisheddown")
-                        finisheddown=True
+                elif not finisheddown: 
+                    if not finishedup:
+                        offset=offset+off_increment
+                        offset=-1*offset
                         updir=True
-                    if finishedup and finisheddown:
-                        if a2kpverbose:
-                            print("Crap - re-keying failed")
-                        nonewkey=True
-                        break
+                    else:
+                        offset=offset-off_increment
+                newkeynum=keynum+offset
+                if newkeynum>=high_num:
                     if a2kpverbose:
-                        print("nk: " + str(newkeynum) + " offset: " + str(offset)) 
-
-                if nonewkey:
+                        print("re-keying finishedup")
+                    finishedup=True
+                    updir=False
+                if newkeynum<=low_num:
+                    if a2kpverbose:
+                        print("re-keying finisheddown")
+                    finisheddown=True
+                    updir=True
+                if finishedup and finisheddown:
+                    if a2kpverbose:
+                        print("Crap - re-keying failed")
+                    nonewkey=True
                     break
-
-                if midicsv[ind][0]!=channelno:
-                    # oops
-                    print("Fell off end of channel while re-keying")
-                    sys.exit(7)
-                if midicsv[ind][2]==',note_off_c,' and midicsv[ind][4]==keynum:
+                if a2kpverbose:
+                    print("nk: " + str(newkeynum) + " offset: " + str(offset)) 
+
+            if not nonewkey:
+                # the matching note-off is the 1st one for this key from here
+                keyoffs=offs.get((channelno,keynum),[])
+                oind=bisect.bisect_left(keyoffs,thisind)
+                if oind<len(keyoffs):
+                    ind=keyoffs.pop(oind)
                     # switch the keynums, here and there
+                    ons[tuple(line)].remove(thisline)
                     line[4]=newkeynum
+                    bisect.insort(ons.setdefault(tuple(line),[]),thisline)
                     midicsv[ind][4]=newkeynum
+                    bisect.insort(offs.setdefault((channelno,newkeynum),[]),ind)
                     keys[newkeynum]=True
                     fixed=True
                     if a2kpverbose:
                         print("Re-keyed from " + str(keynum) + " to " + str(newkeynum))
-                    break
+                elif track_end[channelno]<len(midicsv):
+                    # oops
+                    print("Fell off end of channel while re-keying")
+                    sys.exit(7)
 
             if not fixed:
                 if a2kpverbose:
@@ -637,10 +614,11 @@ def avoid2keypresses(midicsv):
         print("exiting a2kp " + str(keys) + "\n")
 
 # the velocity with which we hit keys, this function will
-# all us play with that
-def velocity(notenum,channel,offset,duration,overall_duration):
+# all us play with that, channel and offset are numpy arrays
+# (one per note) and we give back an array
+def velocities(channel,offset,overall_duration):
     # starting point
-    vel=int(81-4*channel)
+    vel=(81-4*channel).astype(numpy.int64)
     # let's try out a few options, see what sounds better and then
     # make those command line args later (maybe)
     option="midloud"
@@ -648,12 +626,19 @@ def velocity(notenum,channel,offset,duration,overall_duration):
         # start quieter, then loud in middle, then quieter again
         # but still keep earlier channels louder
         # 81 is max, 40 is min
-        sine_adjust=math.sin(math.pi*offset/overall_duration)
+        if overall_duration > 0:
+            sine_adjust=numpy.sin(math.pi*offset/overall_duration)
+        else:
+            # everything happened at once (e.g. one packet), there's no
+            # middle to be loud in so treat it all as the start, i.e.
+            # minvel, rather than dividing by zero
+            sine_adjust=numpy.zeros(len(offset),dtype=numpy.float64)
         dperchan=0.5*(maxvel-minvel)/nchans
         vel=maxvel-minvel-channel*dperchan
-        newvel=minvel+int(vel*sine_adjust)
+        newvel=minvel+numpy.trunc(vel*sine_adjust).astype(numpy.int64)
         if args.verbose:
-            print("Sine ajdusted from " + str(vel) + " to " + str(newvel) + " sa: " + str(sine_adjust) + " off: " + str(offset) + " overall: " + str(overall_duration))
+            for v,nv,sa,off in zip(vel.tolist(),newvel.tolist(),sine_adjust.tolist(),offset.tolist()):
+                print("Sine ajdusted from " + str(v) + " to " + str(nv) + " sa: " + str(sa) + " off: " + str(off) + " overall: " + str(overall_duration))
         vel=newvel
     return vel
 
@@ -664,7 +649,7 @@ def velocity(notenum,channel,offset,duration,overall_duration):
 argparser=argparse.ArgumentParser(description='Turn some pcaps into music')
 argparser.add_argument('-l','--label',     
                     dest='label',
-                    help='basename label for midi.csv and .wav output files')
+                    help='basename label for .midi and .wav output files')
 argparser.add_argument('-f','--file',     
                     dest='fodname',
                     help='PCAP file or directory name')
@@ -717,6 +702,20 @@ argparser.add_argument('-z','--sessionsonly',
 argparser.add_argument('-d','--drums',
                     help='add drumbeats, once per packet',
                     action='store_true')
+argparser.add_argument('-p','--parser',
+                    dest='parser',
+                    choices=['pyshark','native'],
+                    default='pyshark',
+                    help='pcap parser: "pyshark" (default, via tshark) or "native" (quicker)')
+argparser.add_argument('-j','--jobs',
+                    type=int, dest='jobs', default=1,
+                    help='number of pcap files to parse in parallel (default: 1)')
+argparser.add_argument('-C','--cache-dir',
+                    dest='cache_dir',
+                    help='keep parsed sessions in this directory and re-use them for unchanged pcaps')
+argparser.add_argument('-x','--midicsv',
+                    help='also write a .midi.csv (csvmidi text) file for each .midi, for debugging',
+                    action='store_true')
 args=argparser.parse_args()
 
 if args.fodname is not None:
@@ -788,6 +787,11 @@ if args.vantage is not None:
     if args.verbose:
         print("Vantage point set, selectors: " + str(selectors))
 
+# compile the prefixes once for selector_match, see PrefixMatcher
+selmatcher=None
+if type(selectors)==list:
+    selmatcher=PrefixMatcher(selectors)
+
 # make list of file names to process
 flist=set()
 # input string could be space sep list of file or directory names
@@ -815,7 +819,7 @@ if args.verbose:
     print(flist)
 
 sessions=[]
-analyse_pcaps(flist,sessions,args.verbose)
+analyse_pcaps(flist,sessions,args.verbose,args.parser,args.jobs,cache_dir=args.cache_dir)
 if args.verbose:
     print("Found " + str(len(sessions)) + " sessions.\n")
     for s in sessions:
@@ -877,25 +881,40 @@ if len(primary_arr)>=15:
 
 # group our sessions according to selector
 # and keep tabs on overall duration of sessions in groups
+# sets are indexed by selector value (for src/dst that's the IP) so
+# we don't search the_arr for each session, and we note which set
+# each session lands in (for find_set)
+set_by_sel={}
+for w in the_arr:
+    set_by_sel[w.selector]=w
+sess_sets={}
 for s in sessions:
     if s.dst in block_arr or s.src in block_arr:
         if args.verbose:
             print("Ignoring blocked session: " + s.src + "->" + s.dst)
         continue
     w=None
-    for sl in the_arr:
-        matches,sel=selector_match(s,selectors,sl.selector)
-        if w is None and matches:
-            if args.verbose:
-                print("Selecting session: " + s.src + "->" + s.dst)
-            w=sl
-            break;
+    if type(selectors)==str and selectors=='all':
+        w=set_by_sel.get('all')
+    elif type(selectors)==str and selectors=='src':
+        w=set_by_sel.get(s.src)
+    elif type(selectors)==str and selectors=='dst':
+        w=set_by_sel.get(s.dst)
+    elif type(selectors)==list and len(the_arr)>0:
+        # any session matching a prefix matches the 1st set, and only
+        # those can match by IP too, so there's only ever one set here
+        matches,sel=selector_match(s,selectors,the_arr[0].selector,selmatcher)
+        if matches:
+            w=the_arr[0]
+    if w is not None and args.verbose:
+        print("Selecting session: " + s.src + "->" + s.dst)
     if w is None and type(selectors)==list:
-        matches, sel= selector_match(s,selectors)
+        matches, sel= selector_match(s,selectors,pm=selmatcher)
         if matches:
             w=tls_session_set()
             w.selector=sel
             the_arr.append(w)
+            set_by_sel[w.selector]=w
             if args.verbose:
                 print("Matched session: " + s.src + "->" + s.dst + " Matching on " + sel )
         else:
@@ -906,10 +925,12 @@ for s in sessions:
         w=tls_session_set()
         w.selector=s.src
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None and type(selectors)==str and selectors=='dst':
         w=tls_session_set()
         w.selector=s.dst
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None:
         print("Oops - w is None when it shouldn't be")
         sys.exit(3)
@@ -927,6 +948,7 @@ for s in sessions:
         pass
     w.nsessions += 1
     w.sessions.append(s)
+    sess_sets[s.sess_id]=w
 
     # possibly extend duration based on last packet timing
     if len(s.s_delays) > 0 :
@@ -1034,14 +1056,14 @@ for w in the_arr:
             w.notes.append(n)
 
         else:
-            for i in range(0,len(s.s_psizes)):
-                freq,dur=size2freqdur(s.s_psizes[i],s.min_pdu,s.max_pdu,s.num_sizes,True,lowest_note,highest_note)
-                n=noteinfo(freq,dur,(s.s_delays[i]+s.timestamp)-w.earliest,s.s_psizes[i],True,s.channel,track+2,s.instrument)
-                w.notes.append(n)
-            for i in range(0,len(s.d_psizes)):
-                freq,dur=size2freqdur(s.d_psizes[i],s.min_pdu,s.max_pdu,s.num_sizes,False,lowest_note,highest_note)
-                n=noteinfo(freq,dur,(s.d_delays[i]+s.timestamp)-w.earliest,s.d_psizes[i],False,s.channel,track+2,s.instrument)
-                w.notes.append(n)
+            # all of each direction's packets in one go
+            for psizes,delays,c2s in ((s.s_psizes,s.s_delays,True),(s.d_psizes,s.d_delays,False)):
+                if len(psizes)==0:
+                    continue
+                freqs,durs=sizes2freqdurs(numpy.array(psizes,dtype=numpy.float64),s.min_pdu,s.max_pdu,s.num_sizes,c2s,lowest_note,highest_note)
+                starts=(numpy.array(delays,dtype=numpy.float64)+s.timestamp)-w.earliest
+                w.notes.extend(noteinfo(freq,dur,start,psize,c2s,s.channel,track+2,s.instrument) 
+                        for freq,dur,start,psize in zip(freqs.tolist(),durs.tolist(),starts.tolist(),psizes))
 
         if args.drums:
             # add a drum hit for each packet, different percussion instrument for c2s and s2c
@@ -1050,82 +1072,82 @@ for w in the_arr:
             # so we'll try note 35 (acoustic bass drum) = 65Hz for c2s
             # and note 38 (acoustic snare) = 77Hz for s2c
             # but we hardcode drums for now
-            for i in range(0,len(s.s_psizes)):
-                n=noteinfo(65,50,(s.s_delays[i]+s.timestamp)-w.earliest,100,True,9,track+2,9)
-                n.notenum=35
-                w.notes.append(n)
-            for i in range(0,len(s.d_psizes)):
-                n=noteinfo(77,50,(s.d_delays[i]+s.timestamp)-w.earliest,200,True,9,track+2,9)
-                n.notenum=38
-                w.notes.append(n)
+            for delays,freq,psize,drum in ((s.s_delays,65,100,35),(s.d_delays,77,200,38)):
+                starts=(numpy.array(delays,dtype=numpy.float64)+s.timestamp)-w.earliest
+                for start in starts.tolist():
+                    n=noteinfo(freq,50,start,psize,True,9,track+2,9)
+                    n.notenum=drum
+                    w.notes.append(n)
         track+=1
 
 # sort notes timewise
 for w in the_arr:
-    w.notes=sorted(w.notes, key=get_start)
+    w.notes.sort(key=get_start)
     if args.verbose:
         print(w)
         print("\n")
 
-# pick notes from frequencies and handle time munging
+# pick notes from frequencies and handle time munging, we do
+# all of a set's notes at once as arrays and then fill those in
+low_num=freq2num(lowest_note)
+high_num=freq2num(highest_note)
 for w in the_arr:
-    table={}
-    for note in w.notes:
-        if note.channel!=9:
+    if len(w.notes)==0:
+        continue
+    table=keytable()
+    channels=numpy.array([note.channel for note in w.notes],dtype=numpy.int64)
+    starts=numpy.array([note.start for note in w.notes],dtype=numpy.float64)
+    durations=numpy.array([note.duration for note in w.notes],dtype=numpy.float64)
+    notenums=numpy.array([note.notenum for note in w.notes],dtype=numpy.int64)
+    # drums (channel 9) are already assigned
+    tuned=(channels!=9)
+    if numpy.any(tuned):
+        if args.notegen == 'freq':
             # freq2note version
-            # table version - default
-            notenum=size2num(note.packetsize,note.c2s,table)
-            if args.notegen == 'freq':
-                notenum=freq2num(note.freq)
-            # let's move all notes up by N octaves where N is the channel number and
-            # do that modulo our bounds
-            low_num=freq2num(lowest_note)
-            high_num=freq2num(highest_note)
-            increment=(note.channel*7)%(high_num-low_num)
-            notenum = notenum + increment
-            if notenum>=high_num:
-                notenum -= (high_num-low_num)
+            tnums=freqs2nums(numpy.array([note.freq for note in w.notes],dtype=numpy.float64)[tuned])
         else:
-            # already assigned
-            notenum=note.notenum
-        # linear time
-        ontime=time_dilation*int(note.start)
-        offtime=time_dilation*int(note.start+note.duration)
-        # change if log time...
-        if args.logtime:
-            try:
-                if note.start==0:
-                    # can happen!
-                    ontime=0
-                else:
-                    # add a millisecond to avoid negative logs
-                    ontime=time_dilation*int(100*math.log(1+note.start))
-                if note.start+note.duration==0:
-                    # shouldn't happen really 
-                    print("ouch2! processing " + w.fname)
-                    print(str(w))
-                    sys.exit(1)
-                else:
-                    # add a millisecond to avoid negative logs
-                    offtime=time_dilation*int(100*math.log(1+note.start+note.duration))
-            except Exception as e:
-                print("ouch! processing " + w.fname)
-                print(str(w))
-                sys.exit(1)
-        # Try another time compression - log compresses too much
-        if args.scaledtime:
-            ontime=time_dilation*scaletime(note.start)
-            offtime=time_dilation*scaletime(note.start+note.duration)
-        # bit of paranoia...
-        if ontime < 0.0:
-            print("Weird ontime: " + str(ontime))
-            sys.exit(4)
-        if offtime < 0.0:
-            print("Weird offtime: " + str(offtime))
-            sys.exit(4)
-        # handle velocity (loudness) 
-        vel=velocity(notenum,note.channel,ontime,offtime-ontime,w.overall_duration)
-        # add what we've calculated to note, in cols 6-9
+            # table version - default
+            psizes=numpy.array([note.packetsize for note in w.notes],dtype=numpy.int64)[tuned]
+            c2s=numpy.array([note.c2s for note in w.notes],dtype=bool)[tuned]
+            tnums=sizes2nums(psizes,c2s,table)
+        # let's move all notes up by N octaves where N is the channel number and
+        # do that modulo our bounds
+        increment=(channels[tuned]*7)%(high_num-low_num)
+        tnums = tnums + increment
+        tnums = numpy.where(tnums>=high_num,tnums-(high_num-low_num),tnums)
+        notenums[tuned]=tnums
+    # linear time
+    ontimes=time_dilation*numpy.trunc(starts).astype(numpy.int64)
+    offtimes=time_dilation*numpy.trunc(starts+durations).astype(numpy.int64)
+    # change if log time...
+    if args.logtime:
+        if numpy.any(starts+durations==0):
+            # shouldn't happen really 
+            print("ouch2! processing " + w.fname)
+            print(str(w))
+            sys.exit(1)
+        if numpy.any(1+starts<=0) or numpy.any(1+starts+durations<=0):
+            print("ouch! processing " + w.fname)
+            print(str(w))
+            sys.exit(1)
+        # add a millisecond to avoid negative logs, start of 0 can happen!
+        ontimes=numpy.where(starts==0,0,time_dilation*numpy.trunc(100*numpy.log(1+starts)).astype(numpy.int64))
+        offtimes=time_dilation*numpy.trunc(100*numpy.log(1+starts+durations)).astype(numpy.int64)
+    # Try another time compression - log compresses too much
+    if args.scaledtime:
+        ontimes=time_dilation*scaletimes(starts)
+        offtimes=time_dilation*scaletimes(starts+durations)
+    # bit of paranoia...
+    if numpy.any(ontimes < 0.0):
+        print("Weird ontime: " + str(ontimes[ontimes<0.0][0]))
+        sys.exit(4)
+    if numpy.any(offtimes < 0.0):
+        print("Weird offtime: " + str(offtimes[offtimes<0.0][0]))
+        sys.exit(4)
+    # handle velocity (loudness) 
+    vels=velocities(channels,ontimes,w.overall_duration)
+    # add what we've calculated to notes
+    for note,notenum,ontime,offtime,vel in zip(w.notes,notenums.tolist(),ontimes.tolist(),offtimes.tolist(),vels.tolist()):
         note.notenum=notenum
         note.ontime=ontime
         note.offtime=offtime
@@ -1134,17 +1156,19 @@ for w in the_arr:
     # print(table)
     del table
 
-# write out midicsv file, one per src ip
+# write out midi file, one per src ip
 # to play such:
-#   $ csvmidi <hash>.midi.csv <hash>.midi
 #   $ timidity <hash>.midi
+# with -x we also write the text form, that'd be turned into
+# the same via:
+#   $ csvmidi <hash>.midi.csv <hash>.midi
 for w in the_arr:
     if len(w.notes)==0:
         if args.verbose:
-            print("Not writing to " + w.fname + ".midi.csv - no notes!")
+            print("Not writing to " + w.fname + ".midi - no notes!")
         continue
     if args.verbose:
-        print("Writing to " + w.fname + ".midi.csv")
+        print("Writing to " + w.fname + ".midi")
 
     # we'll just keep an array of strings with one line per and won't
     # bother making a python CSV structure
@@ -1156,23 +1180,30 @@ for w in the_arr:
             midicsv.append([note.track,note.ontime+repeat_offset,",note_on_c,",note.channel,note.notenum,note.vel,note.instrument])
             midicsv.append([note.track,note.offtime+repeat_offset,",note_off_c,",note.channel,note.notenum,0,note.instrument])
     
-    # now sort again by time
-    midicsv.sort(key=itemgetter(1))
+    # now sort by track/channel and then time, in one go, that's stable
+    # so same-time events stay in the order we made them
+    midicsv.sort(key=itemgetter(0,1))
 
-    # eliminate any non-changing time gaps > specified limit
+    # eliminate any non-changing time gaps > specified limit, that has
+    # to go through all tracks' events in time order, each track is in
+    # time order already so we just merge those
     if args.suppress_silence is not None:
-        killsilence(midicsv,args.suppress_silence)
-    
-    # now sort by track/channel
-    midicsv.sort(key=itemgetter(0))
+        tracks=[list(evs) for trk,evs in itertools.groupby(midicsv,key=itemgetter(0))]
+        killsilence(heapq.merge(*tracks,key=itemgetter(1)),args.suppress_silence)
+        del tracks
 
     # do what this says
     avoid2keypresses(midicsv)
 
-    with open(w.fname+".midi.csv","w") as f:
-        # precursor
-        current_track=midicsv[0][0]
-        f.write('0, 0, Header, 1, '+str(w.nsessions+1)+', 480\n\
+    write_midi(w.fname+".midi",midicsv,"Tls2Music " + w.fname,lambda channel,inst: int(instrument(instrumentnum,inst)))
+
+    if args.midicsv:
+        if args.verbose:
+            print("Writing to " + w.fname + ".midi.csv")
+        with open(w.fname+".midi.csv","w") as f:
+            # precursor
+            current_track=midicsv[0][0]
+            f.write('0, 0, Header, 1, '+str(w.nsessions+1)+', 480\n\
 1, 0, Start_track\n\
 1, 0, Title_t, "Tls2Music ' + w.fname + '"\n\
 1, 0, Text_t, "see https://github.com/sftcd/tlspad/"\n\
@@ -1183,19 +1214,19 @@ for w in the_arr:
 str(current_track) + ', 0, Start_track\n' +
 str(current_track) + ', 0, Instrument_name_t, "channel ' + str(midicsv[0][3]) + ' "\n' +
 str(current_track) + ', 0, Program_c, '+ str(midicsv[0][3]) + ', ' + instrument(instrumentnum,midicsv[0][6]) + '\n')
-        last_track_end=0
-        for line in midicsv:
-            if line[0]!=current_track:
-                f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
-                current_track=line[0]
-                f.write(str(current_track)+', 0, Start_track\n')
-                f.write(str(current_track)+', 0, Instrument_name_t, "channel '+str(line[3])+'"\n')
-                f.write(str(current_track)+', 0, Program_c,'+str(line[3])+','+ instrument(instrumentnum,line[6]) + '\n')
-            last_track_end=line[1]
-            f.write(str(line[0])+","+str(line[1])+line[2]+str(line[3])+","+str(line[4])+","+str(line[5])+"\n")
-        f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
-        f.write('0, 0, End_of_file\n')
-        f.close()
+            last_track_end=0
+            for line in midicsv:
+                if line[0]!=current_track:
+                    f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
+                    current_track=line[0]
+                    f.write(str(current_track)+', 0, Start_track\n')
+                    f.write(str(current_track)+', 0, Instrument_name_t, "channel '+str(line[3])+'"\n')
+                    f.write(str(current_track)+', 0, Program_c,'+str(line[3])+','+ instrument(instrumentnum,line[6]) + '\n')
+                last_track_end=line[1]
+                f.write(str(line[0])+","+str(line[1])+line[2]+str(line[3])+","+str(line[4])+","+str(line[5])+"\n")
+            f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
+            f.write('0, 0, End_of_file\n')
+            f.close()
     del midicsv
 
 # write out .wav files, one per src ip
@@ -1205,15 +1236,10 @@ if args.wav:
             print("Saving " + w.fname + ".wav")
             # print(str(w))
 
-        # Audio will contain a long list of samples (i.e. floating point numbers describing the
-        # waveform).  If you were working with a very long sound you'd want to stream this to
-        # disk instead of buffering it all in memory list this.  But most sounds will fit in 
-        # memory.
-        waudio = []
-        # make space for required duration plus 2s
-        append_silence(audio=waudio,sample_rate=sample_freq,duration_milliseconds=w.overall_duration+2000)
-        for note in w.notes:
-            inject_sinewave(audio=waudio,sample_rate=sample_freq,freq=note.freq,start_time=note.start,duration_milliseconds=note.duration,volume=0.25)
-        save_wav(w.fname+".wav",audio=waudio,sample_rate=sample_freq)
+        # The audio is a long list of samples (i.e. floating point numbers describing the
+        # waveform), render_wav streams that to disk a block at a time so very long
+        # sounds are ok. We make the required duration plus 2s.
+        wnotes=[(inject_sinewave,note.freq,note.start,note.duration,0.25) for note in w.notes]
+        render_wav(w.fname+".wav",notes=wnotes,sample_rate=sample_freq,duration_milliseconds=w.overall_duration+2000)
 
 
@@ -76,10 +76,14 @@ import hmac,hashlib,base64
 
 # for sorting
 from operator import itemgetter
+import heapq,itertools
 
 # hacky beeps
 from beeps import *
 
+# .midi output
+from midifile import write_midi
+
 # Parameters that can be overridden via command line arguments
 
 # take file or directory name on command line, default to current dir
@@ -419,76 +423,20 @@ def cadence2onechord(cadence,base,channel,track,instrument,verbose):
         achord.notes.append(n)
     return achord
 
-def selector_match(s,sels,sl=""):
-    '''
-    check if TLS session matches selector
-    selector is a (list of) IP prefixes (v4/v6)
-    '''
-    matches=False
-    thesel=""
-    mbranch="0"
-    #smverbose=args.verbose:
-    smverbose=False
-    if smverbose:
-        print("Checking " + str(s.sess_id) +  " vs. Sels="+str(sels)+" type(sels): " + str(type(sels)) + " sl: " + str(sl))
-        print("src: " + s.src + " dst: " + s.dst)
-    if type(sels)==str and sels=='all': 
-        mbranch="1"
-        matches=True
-        thesel="all"
-    elif type(sels)==str and sels=='src' and sl is not None and sl==s.src: 
-        mbranch="2"
-        matches=True
-        matches=True
-        thesel="src"
-    elif type(sels)==str and sels=='dst' and sl is not None and sl==s.dst: 
-        mbranch="3"
-        matches=True
-        thesel="dst"
-    elif type(sels)==list:
-        if sl is not None:
-            if s.src==sl:
-                mbranch="6"
-                matches=True
-                thesel=sl
-            elif s.dst==sl:
-                mbranch="7"
-                matches=True
-                thesel=sl
-        if not matches:
-            for sel in sels:
-                ipsel=ipaddress.ip_network(sel)
-                if smverbose:
-                    print("Inner checking " + s.src + " vs: " + str(ipsel))
-                if ipaddress.ip_address(s.src) in ipsel:
-                    mbranch="4"
-                    matches=True
-                    thesel=s.src
-                if not matches and smverbose:
-                    print("Inner checking " + s.dst + " vs: " + str(ipsel))
-                if not matches and ipaddress.ip_address(s.dst) in ipsel:
-                    mbranch="5"
-                    matches=True
-                    thesel=s.dst
-                if matches:
-                    break
-    if smverbose:
-        print("Checked " + str(s.sess_id) +  " vs. " + str(sels) + " result: " + str(matches) + " " + thesel + " branch:" + mbranch)
-    return matches,thesel
-
 def find_set(s,session_sets):
     '''
     search for tls_session_set mwith matching IPs
+    sessions are noted in sess_sets as they're grouped so that's
+    just a lookup by sess_id
     '''
     if len(session_sets)==0:
         if args.verbose:
             print("find_set: Empty set of session_sets!")
-    for w in session_sets:
-        for s1 in w.sessions:
-            if s.sess_id==s1.sess_id:
-                #if args.verbose:
-                    #print("find_set picked:"+str(w))
-                return w
+    w=sess_sets.get(s.sess_id)
+    if w is not None:
+        #if args.verbose:
+            #print("find_set picked:"+str(w))
+        return w
     if args.verbose:
         print("find_set picked none!")
     return None
@@ -548,32 +496,6 @@ def instrument(inum,hashedinst):
     print("Error: bad instrument number: " + str(inum) + " on channel: " + str(channel))
     return "ERROR"
 
-def killsilence(array, mingap):
-    '''
-    array has notes:
-        [track,on/off-time,on/off-string,channel,notenum,velocity]
-    - we want to eliminate any no-change periods >limit ms long by
-    reducing the times accordingly
-    - that zaps both silences and over-long notes, but good enough
-    '''
-    time2remove=0
-    lasttime=0
-    for note in array:
-        note[1]-=time2remove
-        #print("outer: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-        wasinner=False
-        while (lasttime+mingap)<note[1]:
-            note[1]-=mingap
-            time2remove+=mingap
-            #print("inner: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            wasinner=True
-
-        lasttime=note[1]
-        if wasinner:
-            #print("innerX note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            pass
-    return
-
 # scale time oddly...
 def scaletime(x):
     '''
@@ -624,7 +546,7 @@ def velocity(notenum,channel,offset,duration,overall_duration):
 argparser=argparse.ArgumentParser(description='Turn some pcaps into music')
 argparser.add_argument('-l','--label',     
                     dest='label',
-                    help='basename label for midi.csv and .wav output files')
+                    help='basename label for .midi and .wav output files')
 argparser.add_argument('-f','--file',     
                     dest='fodname',
                     help='PCAP file or directory name')
@@ -652,6 +574,20 @@ argparser.add_argument('-d','--drums',
 argparser.add_argument('-c','--chords',
                     help='map TLS patterns to chords, not notes',
                     action='store_true')
+argparser.add_argument('-p','--parser',
+                    dest='parser',
+                    choices=['pyshark','native'],
+                    default='pyshark',
+                    help='pcap parser: "pyshark" (default, via tshark) or "native" (quicker)')
+argparser.add_argument('-j','--jobs',
+                    type=int, dest='jobs', default=1,
+                    help='number of pcap files to parse in parallel (default: 1)')
+argparser.add_argument('-C','--cache-dir',
+                    dest='cache_dir',
+                    help='keep parsed sessions in this directory and re-use them for unchanged pcaps')
+argparser.add_argument('-x','--midicsv',
+                    help='also write a .midi.csv (csvmidi text) file for each .midi, for debugging',
+                    action='store_true')
 args=argparser.parse_args()
 
 if args.fodname is not None:
@@ -699,6 +635,11 @@ if args.vantage is not None:
     if args.verbose:
         print("Vantage point set, selectors: " + str(selectors))
 
+# compile the prefixes once for selector_match, see PrefixMatcher
+selmatcher=None
+if type(selectors)==list:
+    selmatcher=PrefixMatcher(selectors)
+
 # make list of file names to process
 flist=set()
 # input string could be space sep list of file or directory names
@@ -726,7 +667,7 @@ if args.verbose:
     print(flist)
 
 sessions=[]
-analyse_pcaps(flist,sessions,args.verbose)
+analyse_pcaps(flist,sessions,args.verbose,args.parser,args.jobs,cache_dir=args.cache_dir)
 if args.verbose:
     print("Found " + str(len(sessions)) + " sessions.\n")
     for s in sessions:
@@ -788,25 +729,40 @@ if len(primary_arr)>=15:
 
 # group our sessions according to selector
 # and keep tabs on overall duration of sessions in groups
+# sets are indexed by selector value (for src/dst that's the IP) so
+# we don't search the_arr for each session, and we note which set
+# each session lands in (for find_set)
+set_by_sel={}
+for w in the_arr:
+    set_by_sel[w.selector]=w
+sess_sets={}
 for s in sessions:
     if s.dst in block_arr or s.src in block_arr:
         if args.verbose:
             print("Ignoring blocked session: " + s.src + "->" + s.dst)
         continue
     w=None
-    for sl in the_arr:
-        matches,sel=selector_match(s,selectors,sl.selector)
-        if w is None and matches:
-            if args.verbose:
-                print("Selecting session: " + s.src + "->" + s.dst)
-            w=sl
-            break;
+    if type(selectors)==str and selectors=='all':
+        w=set_by_sel.get('all')
+    elif type(selectors)==str and selectors=='src':
+        w=set_by_sel.get(s.src)
+    elif type(selectors)==str and selectors=='dst':
+        w=set_by_sel.get(s.dst)
+    elif type(selectors)==list and len(the_arr)>0:
+        # any session matching a prefix matches the 1st set, and only
+        # those can match by IP too, so there's only ever one set here
+        matches,sel=selector_match(s,selectors,the_arr[0].selector,selmatcher)
+        if matches:
+            w=the_arr[0]
+    if w is not None and args.verbose:
+        print("Selecting session: " + s.src + "->" + s.dst)
     if w is None and type(selectors)==list:
-        matches, sel= selector_match(s,selectors)
+        matches, sel= selector_match(s,selectors,pm=selmatcher)
         if matches:
             w=tls_session_set()
             w.selector=sel
             the_arr.append(w)
+            set_by_sel[w.selector]=w
             if args.verbose:
                 print("Matched session: " + s.src + "->" + s.dst + " Matching on " + sel )
         else:
@@ -817,10 +773,12 @@ for s in sessions:
         w=tls_session_set()
         w.selector=s.src
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None and type(selectors)==str and selectors=='dst':
         w=tls_session_set()
         w.selector=s.dst
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None:
         print("Oops - w is None when it shouldn't be")
         sys.exit(3)
@@ -838,6 +796,7 @@ for s in sessions:
         pass
     w.nsessions += 1
     w.sessions.append(s)
+    sess_sets[s.sess_id]=w
 
     # possibly extend duration based on last packet timing
     if len(s.s_delays) > 0 :
@@ -964,7 +923,7 @@ for w in the_arr:
 
 # sort notes timewise
 for w in the_arr:
-    w.notes=sorted(w.notes, key=get_start)
+    w.notes.sort(key=get_start)
     if args.verbose:
         print(w)
         print("\n")
@@ -995,17 +954,19 @@ for w in the_arr:
         note.offtime=offtime
         note.vel=vel
 
-# write out midicsv file, one per src ip
+# write out midi file, one per src ip
 # to play such:
-#   $ csvmidi <hash>.midi.csv <hash>.midi
 #   $ timidity <hash>.midi
+# with -x we also write the text form, that'd be turned into
+# the same via:
+#   $ csvmidi <hash>.midi.csv <hash>.midi
 for w in the_arr:
     if len(w.notes)==0:
         if args.verbose:
-            print("Not writing to " + w.fname + ".midi.csv - no notes!")
+            print("Not writing to " + w.fname + ".midi - no notes!")
         continue
     if args.verbose:
-        print("Writing to " + w.fname + ".midi.csv")
+        print("Writing to " + w.fname + ".midi")
 
     # we'll just keep an array of strings with one line per and won't
     # bother making a python CSV structure
@@ -1017,20 +978,27 @@ for w in the_arr:
             midicsv.append([note.track,int(note.ontime+repeat_offset),"Note_on_c",note.channel,note.notenum,note.vel,note.instrument])
             midicsv.append([note.track,int(note.offtime+repeat_offset),"Note_off_c",note.channel,note.notenum,0,note.instrument])
     
-    # now sort again by time
-    midicsv.sort(key=itemgetter(1))
+    # now sort by track/channel and then time, in one go, that's stable
+    # so same-time events stay in the order we made them
+    midicsv.sort(key=itemgetter(0,1))
 
-    # eliminate any non-changing time gaps > specified limit
+    # eliminate any non-changing time gaps > specified limit, that has
+    # to go through all tracks' events in time order, each track is in
+    # time order already so we just merge those
     if args.suppress_silence is not None:
-        killsilence(midicsv,args.suppress_silence)
-    
-    # now sort by track/channel
-    midicsv.sort(key=itemgetter(0))
+        tracks=[list(evs) for trk,evs in itertools.groupby(midicsv,key=itemgetter(0))]
+        killsilence(heapq.merge(*tracks,key=itemgetter(1)),args.suppress_silence)
+        del tracks
 
-    with open(w.fname+".midi.csv","w") as f:
-        # precursor
-        current_track=midicsv[0][0]
-        f.write('0, 0, Header, 1, '+str(w.nsessions+1)+', 480\n\
+    write_midi(w.fname+".midi",midicsv,"Tls2Music " + w.fname,lambda channel,inst: int(instrument(instrumentnum,inst)))
+
+    if args.midicsv:
+        if args.verbose:
+            print("Writing to " + w.fname + ".midi.csv")
+        with open(w.fname+".midi.csv","w") as f:
+            # precursor
+            current_track=midicsv[0][0]
+            f.write('0, 0, Header, 1, '+str(w.nsessions+1)+', 480\n\
 1, 0, Start_track\n\
 1, 0, Title_t, "Tls2Music ' + w.fname + '"\n\
 1, 0, Text_t, "see https://github.com/sftcd/tlspad/"\n\
@@ -1041,19 +1009,19 @@ for w in the_arr:
 str(current_track) + ', 0, Start_track\n' +
 str(current_track) + ', 0, Instrument_name_t, "channel ' + str(midicsv[0][3]) + ' "\n' +
 str(current_track) + ', 0, Program_c, '+ str(midicsv[0][3]) + ', ' + instrument(instrumentnum,midicsv[0][6]) + '\n')
-        last_track_end=0
-        for line in midicsv:
-            if line[0]!=current_track:
-                f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
-                current_track=line[0]
-                f.write(str(current_track)+', 0, Start_track\n')
-                f.write(str(current_track)+', 0, Instrument_name_t, "channel '+str(line[3])+'"\n')
-                f.write(str(current_track)+', 0, Program_c, '+str(line[3])+', '+ instrument(instrumentnum,line[6]) + '\n')
-            last_track_end=line[1]
-            f.write(str(line[0])+", "+str(line[1])+", "+str(line[2]) + ", "+str(line[3])+", "+str(line[4])+", "+str(line[5])+"\n")
-        f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
-        f.write('0, 0, End_of_file\n')
-        f.close()
+            last_track_end=0
+            for line in midicsv:
+                if line[0]!=current_track:
+                    f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
+                    current_track=line[0]
+                    f.write(str(current_track)+', 0, Start_track\n')
+                    f.write(str(current_track)+', 0, Instrument_name_t, "channel '+str(line[3])+'"\n')
+                    f.write(str(current_track)+', 0, Program_c, '+str(line[3])+', '+ instrument(instrumentnum,line[6]) + '\n')
+                last_track_end=line[1]
+                f.write(str(line[0])+", "+str(line[1])+", "+str(line[2]) + ", "+str(line[3])+", "+str(line[4])+", "+str(line[5])+"\n")
+            f.write(str(current_track)+', '+str(last_track_end)+', End_track\n')
+            f.write('0, 0, End_of_file\n')
+            f.close()
     del midicsv
 
 
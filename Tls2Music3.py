@@ -51,7 +51,7 @@
     We'll try the evnelope first
 '''
 
-import traceback,math
+import traceback,math,bisect
 import os,sys,argparse,re,random,time,ipaddress
 import pyshark
 from TlsPadFncs import *
@@ -411,76 +411,20 @@ def cadence2onechord(cadence,base,channel,track,instrument,verbose):
         achord.notes.append(n)
     return achord
 
-def selector_match(s,sels,sl=""):
-    '''
-    check if TLS session matches selector
-    selector is a (list of) IP prefixes (v4/v6)
-    '''
-    matches=False
-    thesel=""
-    mbranch="0"
-    #smverbose=args.verbose:
-    smverbose=False
-    if smverbose:
-        print("Checking " + str(s.sess_id) +  " vs. Sels="+str(sels)+" type(sels): " + str(type(sels)) + " sl: " + str(sl))
-        print("src: " + s.src + " dst: " + s.dst)
-    if type(sels)==str and sels=='all': 
-        mbranch="1"
-        matches=True
-        thesel="all"
-    elif type(sels)==str and sels=='src' and sl is not None and sl==s.src: 
-        mbranch="2"
-        matches=True
-        matches=True
-        thesel="src"
-    elif type(sels)==str and sels=='dst' and sl is not None and sl==s.dst: 
-        mbranch="3"
-        matches=True
-        thesel="dst"
-    elif type(sels)==list:
-        if sl is not None:
-            if s.src==sl:
-                mbranch="6"
-                matches=True
-                thesel=sl
-            elif s.dst==sl:
-                mbranch="7"
-                matches=True
-                thesel=sl
-        if not matches:
-            for sel in sels:
-                ipsel=ipaddress.ip_network(sel)
-                if smverbose:
-                    print("Inner checking " + s.src + " vs: " + str(ipsel))
-                if ipaddress.ip_address(s.src) in ipsel:
-                    mbranch="4"
-                    matches=True
-                    thesel=s.src
-                if not matches and smverbose:
-                    print("Inner checking " + s.dst + " vs: " + str(ipsel))
-                if not matches and ipaddress.ip_address(s.dst) in ipsel:
-                    mbranch="5"
-                    matches=True
-                    thesel=s.dst
-                if matches:
-                    break
-    if smverbose:
-        print("Checked " + str(s.sess_id) +  " vs. " + str(sels) + " result: " + str(matches) + " " + thesel + " branch:" + mbranch)
-    return matches,thesel
-
 def find_set(s,session_sets):
     '''
     search for tls_session_set mwith matching IPs
+    sessions are noted in sess_sets as they're grouped so that's
+    just a lookup by sess_id
     '''
     if len(session_sets)==0:
         if args.verbose:
             print("find_set: Empty set of session_sets!")
-    for w in session_sets:
-        for s1 in w.sessions:
-            if s.sess_id==s1.sess_id:
-                #if args.verbose:
-                    #print("find_set picked:"+str(w))
-                return w
+    w=sess_sets.get(s.sess_id)
+    if w is not None:
+        #if args.verbose:
+            #print("find_set picked:"+str(w))
+        return w
     if args.verbose:
         print("find_set picked none!")
     return None
@@ -540,32 +484,6 @@ def instrument(inum,hashedinst):
     print("Error: bad instrument number: " + str(inum) + " on channel: " + str(channel))
     return "ERROR"
 
-def killsilence(array, mingap):
-    '''
-    array has notes:
-        [track,on/off-time,on/off-string,channel,notenum,velocity]
-    - we want to eliminate any no-change periods >limit ms long by
-    reducing the times accordingly
-    - that zaps both silences and over-long notes, but good enough
-    '''
-    time2remove=0
-    lasttime=0
-    for note in array:
-        note[1]-=time2remove
-        #print("outer: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-        wasinner=False
-        while (lasttime+mingap)<note[1]:
-            note[1]-=mingap
-            time2remove+=mingap
-            #print("inner: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            wasinner=True
-
-        lasttime=note[1]
-        if wasinner:
-            #print("innerX note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            pass
-    return
-
 # scale time oddly...
 def scaletime(x):
     '''
@@ -641,8 +559,18 @@ def mk_envfilter(s,ftype):
     # sort darr by time
     darr.sort(key=itemgetter(0))
 
+    # sorted times for bisecting, plus where we found the last t, as
+    # we're mostly called with t going up that's usually still right
+    dtimes=[d[0] for d in darr]
+    dnarr=numpy.array(darr,dtype=numpy.float64)
+    cursor=1
+
     def dummy(t,pdarr):
-        # inefficient but improve later
+        nonlocal cursor
+        # t can be a numpy array of times (a block from filter_existing)
+        # in which case we interpolate the lot in one go
+        if isinstance(t,numpy.ndarray):
+            return envblock(t,pdarr)
         # check if before first or after last
         if len(pdarr)==0:
             return 1
@@ -654,18 +582,12 @@ def mk_envfilter(s,ftype):
             return(pdarr[-1][1])
         if t > pdarr[-1][0]:
             return 1
-        f_ind=-2
-        for pind in range(0,len(pdarr)):
-            if t < pdarr[pind][0]:
-                f_ind=pind
-                break;
-        if f_ind==-2:
-            # not found somehow
-            print ("Not found! t = " + str(t) + " ind = " + str(pind) + " prev: " + str(pdarr[pind-1]) + " next: " + str(pdarr[pind]))
-            return 1
-        if f_ind==0:
-            print ("found at start! t = " + str(t) + " ind = " + str(f_ind) + " prev: " + str(pdarr[f_ind-1]) + " next: " + str(pdarr[f_ind]))
-            return(pdarr[0][1])
+        ptimes=dtimes if pdarr is darr else [p[0] for p in pdarr]
+        # f_ind is the 1st entry after t
+        f_ind=cursor
+        if f_ind >= len(ptimes) or not (ptimes[f_ind-1] <= t < ptimes[f_ind]):
+            f_ind=bisect.bisect_right(ptimes,t)
+            cursor=f_ind
         # use linear interpolated value
         t1=pdarr[f_ind-1][0]
         v1=pdarr[f_ind-1][1]
@@ -681,6 +603,30 @@ def mk_envfilter(s,ftype):
         #print ("found! t = " + str(t) + " ind = " + str(f_ind) + " prev: " + str(pdarr[f_ind-1]) + " next: " + str(pdarr[f_ind]) + "interpol=" + str(interpol))
         return interpol
 
+    def envblock(t,pdarr):
+        # same answers as dummy would give one at a time
+        if len(pdarr)==0:
+            return numpy.ones(len(t))
+        narr=dnarr if pdarr is darr else numpy.array(pdarr,dtype=numpy.float64)
+        T=narr[:,0]
+        V=narr[:,1]
+        rv=numpy.ones(len(t))
+        if len(T)>1:
+            # index of 1st entry after t, clipped so the edges don't fall
+            # off, those get fixed up below
+            f_ind=numpy.clip(numpy.searchsorted(T,t,side='right'),1,len(T)-1)
+            t1=T[f_ind-1]
+            v1=V[f_ind-1]
+            t2=T[f_ind]
+            v2=V[f_ind]
+            with numpy.errstate(divide='ignore',invalid='ignore'):
+                m=numpy.where(t2!=t1,(v2-v1)/(t2-t1),1)
+            rv=m*(t-t1)+v1
+        rv=numpy.where(t==T[-1],V[-1],rv)
+        rv=numpy.where(t==T[0],V[0],rv)
+        rv=numpy.where((t<T[0]) | (t>T[-1]),1,rv)
+        return rv
+
     return dummy,darr
 
 # polynomial filter
@@ -723,14 +669,16 @@ def mk_polyfilter(s,ftype):
     print("darr: " + str(darr) + " coords: " + str(coords))
 
     def polydummy(t,coords):
+        # t can be a single time or a numpy array of them
         rval=Poly.polyval(t,coords)
-        mrval=rval
-        if rval > 0:
-            mrval=rval/maxval
-        if rval < 0:
-            mrval=-1.0*rval/minval
-        if ((t%1000)==0):
-            print("polydummy, t=" + str(t) + " coords=" + str(coords) + " rval=" + str(rval) + " mrval: "+ str(mrval) + " max: " + str(maxval) + " min: " + str(minval))
+        mrval=numpy.where(rval>0,rval/maxval,numpy.where(rval<0,-1.0*rval/minval,rval))
+        # just the one report per call, not per sample
+        ticks=numpy.flatnonzero((numpy.asarray(t)%1000)==0)
+        if len(ticks)>0:
+            i=ticks[0]
+            print("polydummy, t=" + str(numpy.ravel(t)[i]) + " coords=" + str(coords) + " rval=" + str(numpy.ravel(rval)[i]) + " mrval: "+ str(numpy.ravel(mrval)[i]) + " max: " + str(maxval) + " min: " + str(minval))
+        if numpy.ndim(t)==0:
+            return float(mrval)
         return mrval
 
     return polydummy,coords
@@ -780,15 +728,17 @@ def mk_splinefilter(s,ftype):
     print(" tck: " + str(tck))
 
     def splinedummy(t,tck):
+        # t can be a single time or a numpy array of them
         rval = interpolate.splev(t, tck, der=0)
-        mrval=rval
-        if mrval>1:
-            mrval=1
-        if mrval<-1:
-            mrval=-1
-        if ((t%100)==0):
-            print("splinedummy, t=" + str(t) + " rval=" + str(rval) + " mrval: "+ str(mrval) + " max: " + str(maxval) + " min: " + str(minval))
+        mrval=numpy.clip(rval,-1,1)
+        # just the one report per call, not per sample
+        ticks=numpy.flatnonzero((numpy.asarray(t)%100)==0)
+        if len(ticks)>0:
+            i=ticks[0]
+            print("splinedummy, t=" + str(numpy.ravel(t)[i]) + " rval=" + str(numpy.ravel(rval)[i]) + " mrval: "+ str(numpy.ravel(mrval)[i]) + " max: " + str(maxval) + " min: " + str(minval))
             print("             tck=" + str(tck))
+        if numpy.ndim(t)==0:
+            return float(mrval)
         return mrval
 
     return splinedummy,tck
@@ -849,6 +799,17 @@ argparser.add_argument('-d','--drums',
 argparser.add_argument('-c','--chords',
                     help='map TLS patterns to chords, not notes',
                     action='store_true')
+argparser.add_argument('-p','--parser',
+                    dest='parser',
+                    choices=['pyshark','native'],
+                    default='pyshark',
+                    help='pcap parser: "pyshark" (default, via tshark) or "native" (quicker)')
+argparser.add_argument('-j','--jobs',
+                    type=int, dest='jobs', default=1,
+                    help='number of pcap files to parse in parallel (default: 1)')
+argparser.add_argument('-C','--cache-dir',
+                    dest='cache_dir',
+                    help='keep parsed sessions in this directory and re-use them for unchanged pcaps')
 args=argparser.parse_args()
 
 if args.fodname is not None:
@@ -896,6 +857,11 @@ if args.vantage is not None:
     if args.verbose:
         print("Vantage point set, selectors: " + str(selectors))
 
+# compile the prefixes once for selector_match, see PrefixMatcher
+selmatcher=None
+if type(selectors)==list:
+    selmatcher=PrefixMatcher(selectors)
+
 # make list of file names to process
 flist=set()
 # input string could be space sep list of file or directory names
@@ -923,7 +889,7 @@ if args.verbose:
     print(flist)
 
 sessions=[]
-analyse_pcaps(flist,sessions,args.verbose)
+analyse_pcaps(flist,sessions,args.verbose,args.parser,args.jobs,cache_dir=args.cache_dir)
 if args.verbose:
     print("Found " + str(len(sessions)) + " sessions.\n")
     for s in sessions:
@@ -985,25 +951,40 @@ if len(primary_arr)>=15:
 
 # group our sessions according to selector
 # and keep tabs on overall duration of sessions in groups
+# sets are indexed by selector value (for src/dst that's the IP) so
+# we don't search the_arr for each session, and we note which set
+# each session lands in (for find_set)
+set_by_sel={}
+for w in the_arr:
+    set_by_sel[w.selector]=w
+sess_sets={}
 for s in sessions:
     if s.dst in block_arr or s.src in block_arr:
         if args.verbose:
             print("Ignoring blocked session: " + s.src + "->" + s.dst)
         continue
     w=None
-    for sl in the_arr:
-        matches,sel=selector_match(s,selectors,sl.selector)
-        if w is None and matches:
-            if args.verbose:
-                print("Selecting session: " + s.src + "->" + s.dst)
-            w=sl
-            break;
+    if type(selectors)==str and selectors=='all':
+        w=set_by_sel.get('all')
+    elif type(selectors)==str and selectors=='src':
+        w=set_by_sel.get(s.src)
+    elif type(selectors)==str and selectors=='dst':
+        w=set_by_sel.get(s.dst)
+    elif type(selectors)==list and len(the_arr)>0:
+        # any session matching a prefix matches the 1st set, and only
+        # those can match by IP too, so there's only ever one set here
+        matches,sel=selector_match(s,selectors,the_arr[0].selector,selmatcher)
+        if matches:
+            w=the_arr[0]
+    if w is not None and args.verbose:
+        print("Selecting session: " + s.src + "->" + s.dst)
     if w is None and type(selectors)==list:
-        matches, sel= selector_match(s,selectors)
+        matches, sel= selector_match(s,selectors,pm=selmatcher)
         if matches:
             w=tls_session_set()
             w.selector=sel
             the_arr.append(w)
+            set_by_sel[w.selector]=w
             if args.verbose:
                 print("Matched session: " + s.src + "->" + s.dst + " Matching on " + sel )
         else:
@@ -1014,10 +995,12 @@ for s in sessions:
         w=tls_session_set()
         w.selector=s.src
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None and type(selectors)==str and selectors=='dst':
         w=tls_session_set()
         w.selector=s.dst
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None:
         print("Oops - w is None when it shouldn't be")
         sys.exit(3)
@@ -1035,6 +1018,7 @@ for s in sessions:
         pass
     w.nsessions += 1
     w.sessions.append(s)
+    sess_sets[s.sess_id]=w
 
     # possibly extend duration based on last packet timing
     if len(s.s_delays) > 0 :
@@ -1072,8 +1056,11 @@ for w in the_arr:
         latest=w.latest
 overall_duration=1000*(latest-earliest)
 
-waudio = []
-append_file(audio=waudio,duration_milliseconds=overall_duration+2000)
+# the input file is filtered as we write it out (see filter_wav), so
+# we just collect the filters here
+wfilters = []
+#waudio = []
+#append_file(audio=waudio,duration_milliseconds=overall_duration+2000)
 #append_silence(audio=waudio,duration_milliseconds=overall_duration+2000)
 #append_sinewave(audio=waudio,duration_milliseconds=overall_duration+2000)
 keynumber=49 # middle-C
@@ -1114,12 +1101,13 @@ for w in the_arr:
             print(farr)
         thefreq=num2freq(keynumber)
         keynumber = (keynumber + 12) % 88
-        filter_existing(audio=waudio,start_time=stime,duration_milliseconds=thedur,thefilter=myfilter,filarr=farr)
+        wfilters.append((stime,thedur,myfilter,farr))
+        #filter_existing(audio=waudio,start_time=stime,duration_milliseconds=thedur,thefilter=myfilter,filarr=farr)
         #inject_sinewave(audio=waudio,freq=thefreq,start_time=stime,duration_milliseconds=thedur)
         #inject_filtered_sinewave(audio=waudio,freq=thefreq,start_time=stime,duration_milliseconds=thedur,thefilter=myfilter,filarr=farr)
         #inject_filtered_constant(audio=waudio,constant=1.0,start_time=stime,duration_milliseconds=thedur,thefilter=myfilter,filarr=farr)
 
 if args.verbose:
     print("Saving " + w.fname + ".wav")
-save_wav(w.fname+".wav",audio=waudio)
+filter_wav(w.fname+".wav",filters=wfilters,duration_milliseconds=overall_duration+2000)
 
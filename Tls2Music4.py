@@ -72,6 +72,9 @@ overall_repeats=1
 # Time-gap between repeats, in ms
 repeat_gap=100
 
+# wav sample rate, 44100 is CD quality
+sample_rate=44100
+
 # Relative start time of drum sessions
 drumlimit=100
 
@@ -389,76 +392,20 @@ def cadence2onechord(cadence,base,channel,track,instrument,verbose):
         achord.notes.append(n)
     return achord
 
-def selector_match(s,sels,sl=""):
-    '''
-    check if TLS session matches selector
-    selector is a (list of) IP prefixes (v4/v6)
-    '''
-    matches=False
-    thesel=""
-    mbranch="0"
-    #smverbose=args.verbose:
-    smverbose=False
-    if smverbose:
-        print("Checking " + str(s.sess_id) +  " vs. Sels="+str(sels)+" type(sels): " + str(type(sels)) + " sl: " + str(sl))
-        print("src: " + s.src + " dst: " + s.dst)
-    if type(sels)==str and sels=='all': 
-        mbranch="1"
-        matches=True
-        thesel="all"
-    elif type(sels)==str and sels=='src' and sl is not None and sl==s.src: 
-        mbranch="2"
-        matches=True
-        matches=True
-        thesel="src"
-    elif type(sels)==str and sels=='dst' and sl is not None and sl==s.dst: 
-        mbranch="3"
-        matches=True
-        thesel="dst"
-    elif type(sels)==list:
-        if sl is not None:
-            if s.src==sl:
-                mbranch="6"
-                matches=True
-                thesel=sl
-            elif s.dst==sl:
-                mbranch="7"
-                matches=True
-                thesel=sl
-        if not matches:
-            for sel in sels:
-                ipsel=ipaddress.ip_network(sel)
-                if smverbose:
-                    print("Inner checking " + s.src + " vs: " + str(ipsel))
-                if ipaddress.ip_address(s.src) in ipsel:
-                    mbranch="4"
-                    matches=True
-                    thesel=s.src
-                if not matches and smverbose:
-                    print("Inner checking " + s.dst + " vs: " + str(ipsel))
-                if not matches and ipaddress.ip_address(s.dst) in ipsel:
-                    mbranch="5"
-                    matches=True
-                    thesel=s.dst
-                if matches:
-                    break
-    if smverbose:
-        print("Checked " + str(s.sess_id) +  " vs. " + str(sels) + " result: " + str(matches) + " " + thesel + " branch:" + mbranch)
-    return matches,thesel
-
 def find_set(s,session_sets):
     '''
     search for tls_session_set mwith matching IPs
+    sessions are noted in sess_sets as they're grouped so that's
+    just a lookup by sess_id
     '''
     if len(session_sets)==0:
         if args.verbose:
             print("find_set: Empty set of session_sets!")
-    for w in session_sets:
-        for s1 in w.sessions:
-            if s.sess_id==s1.sess_id:
-                #if args.verbose:
-                    #print("find_set picked:"+str(w))
-                return w
+    w=sess_sets.get(s.sess_id)
+    if w is not None:
+        #if args.verbose:
+            #print("find_set picked:"+str(w))
+        return w
     if args.verbose:
         print("find_set picked none!")
     return None
@@ -518,32 +465,6 @@ def instrument(inum,hashedinst):
     print("Error: bad instrument number: " + str(inum) + " on channel: " + str(channel))
     return "ERROR"
 
-def killsilence(array, mingap):
-    '''
-    array has notes:
-        [track,on/off-time,on/off-string,channel,notenum,velocity]
-    - we want to eliminate any no-change periods >limit ms long by
-    reducing the times accordingly
-    - that zaps both silences and over-long notes, but good enough
-    '''
-    time2remove=0
-    lasttime=0
-    for note in array:
-        note[1]-=time2remove
-        #print("outer: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-        wasinner=False
-        while (lasttime+mingap)<note[1]:
-            note[1]-=mingap
-            time2remove+=mingap
-            #print("inner: note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            wasinner=True
-
-        lasttime=note[1]
-        if wasinner:
-            #print("innerX note: " + str(note) + " lasttime: " + str(lasttime) + " mingap: " + str(mingap) + " ttr:" + str(time2remove))
-            pass
-    return
-
 # scale time oddly...
 def scaletime(x):
     '''
@@ -827,6 +748,22 @@ argparser.add_argument('-d','--drums',
 argparser.add_argument('-c','--chords',
                     help='map TLS patterns to chords, not notes',
                     action='store_true')
+argparser.add_argument('-p','--parser',
+                    dest='parser',
+                    choices=['pyshark','native'],
+                    default='pyshark',
+                    help='pcap parser: "pyshark" (default, via tshark) or "native" (quicker)')
+argparser.add_argument('-j','--jobs',
+                    type=int, dest='jobs', default=1,
+                    help='number of pcap files to parse in parallel (default: 1)')
+argparser.add_argument('-C','--cache-dir',
+                    dest='cache_dir',
+                    help='keep parsed sessions in this directory and re-use them for unchanged pcaps')
+argparser.add_argument('-R','--render-jobs',
+                    type=int, dest='render_jobs', default=1,
+                    help='render blocks of the wav in parallel with <num> processes, mixing sessions separately (default: 1, no mixing), '
+                         'where sessions overlap in time they are averaged as a whole rather than note by note, '
+                         'so the .wav can differ a little from the serial one')
 args=argparser.parse_args()
 
 if args.fodname is not None:
@@ -874,6 +811,11 @@ if args.vantage is not None:
     if args.verbose:
         print("Vantage point set, selectors: " + str(selectors))
 
+# compile the prefixes once for selector_match, see PrefixMatcher
+selmatcher=None
+if type(selectors)==list:
+    selmatcher=PrefixMatcher(selectors)
+
 # make list of file names to process
 flist=set()
 # input string could be space sep list of file or directory names
@@ -901,7 +843,7 @@ if args.verbose:
     print(flist)
 
 sessions=[]
-analyse_pcaps(flist,sessions,args.verbose)
+analyse_pcaps(flist,sessions,args.verbose,args.parser,args.jobs,cache_dir=args.cache_dir)
 if args.verbose:
     print("Found " + str(len(sessions)) + " sessions.\n")
     for s in sessions:
@@ -963,25 +905,40 @@ if len(primary_arr)>=15:
 
 # group our sessions according to selector
 # and keep tabs on overall duration of sessions in groups
+# sets are indexed by selector value (for src/dst that's the IP) so
+# we don't search the_arr for each session, and we note which set
+# each session lands in (for find_set)
+set_by_sel={}
+for w in the_arr:
+    set_by_sel[w.selector]=w
+sess_sets={}
 for s in sessions:
     if s.dst in block_arr or s.src in block_arr:
         if args.verbose:
             print("Ignoring blocked session: " + s.src + "->" + s.dst)
         continue
     w=None
-    for sl in the_arr:
-        matches,sel=selector_match(s,selectors,sl.selector)
-        if w is None and matches:
-            if args.verbose:
-                print("Selecting session: " + s.src + "->" + s.dst)
-            w=sl
-            break;
+    if type(selectors)==str and selectors=='all':
+        w=set_by_sel.get('all')
+    elif type(selectors)==str and selectors=='src':
+        w=set_by_sel.get(s.src)
+    elif type(selectors)==str and selectors=='dst':
+        w=set_by_sel.get(s.dst)
+    elif type(selectors)==list and len(the_arr)>0:
+        # any session matching a prefix matches the 1st set, and only
+        # those can match by IP too, so there's only ever one set here
+        matches,sel=selector_match(s,selectors,the_arr[0].selector,selmatcher)
+        if matches:
+            w=the_arr[0]
+    if w is not None and args.verbose:
+        print("Selecting session: " + s.src + "->" + s.dst)
     if w is None and type(selectors)==list:
-        matches, sel= selector_match(s,selectors)
+        matches, sel= selector_match(s,selectors,pm=selmatcher)
         if matches:
             w=tls_session_set()
             w.selector=sel
             the_arr.append(w)
+            set_by_sel[w.selector]=w
             if args.verbose:
                 print("Matched session: " + s.src + "->" + s.dst + " Matching on " + sel )
         else:
@@ -992,10 +949,12 @@ for s in sessions:
         w=tls_session_set()
         w.selector=s.src
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None and type(selectors)==str and selectors=='dst':
         w=tls_session_set()
         w.selector=s.dst
         the_arr.append(w)
+        set_by_sel[w.selector]=w
     if w is None:
         print("Oops - w is None when it shouldn't be")
         sys.exit(3)
@@ -1013,6 +972,7 @@ for s in sessions:
         pass
     w.nsessions += 1
     w.sessions.append(s)
+    sess_sets[s.sess_id]=w
 
     # possibly extend duration based on last packet timing
     if len(s.s_delays) > 0 :
@@ -1036,10 +996,9 @@ if len(the_arr)==0:
     print(sys.argv[0] + ": No sessions selected - exiting")
     sys.exit(0)
 
-# Audio will contain a long list of samples (i.e. floating point numbers describing the
-# waveform).  If you were working with a very long sound you'd want to stream this to
-# disk instead of buffering it all in memory list this.  But most sounds will fit in 
-# memory.
+# Audio is a long list of samples (i.e. floating point numbers describing the
+# waveform), we collect the notes here and render_wav streams the samples to
+# disk a block at a time so very long sounds are ok.
 # make space for required duration plus 2s
 earliest=sys.maxsize
 latest=0
@@ -1050,10 +1009,12 @@ for w in the_arr:
         latest=w.latest
 overall_duration=1000*(latest-earliest)
 
-waudio = []
+#waudio = []
 #append_file(audio=waudio,duration_milliseconds=overall_duration+2000)
-append_silence(audio=waudio,duration_milliseconds=overall_duration+2000)
 #append_sinewave(audio=waudio,duration_milliseconds=overall_duration+2000)
+wnotes=[]
+# notes per session, for rendering in parallel
+snotes=[]
 keynumber=49 # middle-C
 for w in the_arr:
     if args.verbose:
@@ -1094,6 +1055,7 @@ for w in the_arr:
 
         basefreq=400
         freqincr=5
+        snotes.append([])
         for ind in range(0,len(sarr)):
             thefreq=(sarr[ind][1]*freqincr+basefreq)%(highest_note-lowest_note)+lowest_note
             start=sarr[ind][0]
@@ -1108,9 +1070,17 @@ for w in the_arr:
             if thisdur==0:
                 print("    Skipping - empty")
             else:
-                inject_sinewave_damp(audio=waudio,freq=thefreq,start_time=start,duration_milliseconds=thisdur)
+                wnotes.append((inject_sinewave_damp,thefreq,start,thisdur,1.0))
+                snotes[-1].append(wnotes[-1])
 
 if args.verbose:
     print("Saving " + w.fname + ".wav")
-save_wav(w.fname+".wav",audio=waudio)
+if args.render_jobs > 1:
+    # sessions are independent until mixed, so render blocks of those
+    # in a pool and then mix them, see mixdown_wav for how
+    with fork_pool(args.render_jobs) as pool:
+        mixdown_wav(w.fname+".wav",groups=snotes,pool=pool,sample_rate=sample_rate,
+                duration_milliseconds=overall_duration+2000,inflight=2*args.render_jobs)
+else:
+    render_wav(w.fname+".wav",notes=wnotes,sample_rate=sample_rate,duration_milliseconds=overall_duration+2000)
 
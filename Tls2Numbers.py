@@ -38,64 +38,6 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from scipy.ndimage.filters import gaussian_filter
 
-def selector_match(s,sels,sl=""):
-    '''
-    check if TLS session matches selector
-    selector is a (list of) IP prefixes (v4/v6)
-    '''
-    matches=False
-    thesel=""
-    mbranch="0"
-    #smverbose=args.verbose:
-    smverbose=False
-    if smverbose:
-        print("Checking " + str(s.sess_id) +  " vs. Sels="+str(sels)+" type(sels): " + str(type(sels)) + " sl: " + str(sl))
-        print("src: " + s.src + " dst: " + s.dst)
-    if type(sels)==str and sels=='all': 
-        mbranch="1"
-        matches=True
-        thesel="all"
-    elif type(sels)==str and sels=='src' and sl is not None and sl==s.src: 
-        mbranch="2"
-        matches=True
-        matches=True
-        thesel="src"
-    elif type(sels)==str and sels=='dst' and sl is not None and sl==s.dst: 
-        mbranch="3"
-        matches=True
-        thesel="dst"
-    elif type(sels)==list:
-        if sl is not None:
-            if s.src==sl:
-                mbranch="6"
-                matches=True
-                thesel=sl
-            elif s.dst==sl:
-                mbranch="7"
-                matches=True
-                thesel=sl
-        if not matches:
-            for sel in sels:
-                ipsel=ipaddress.ip_network(sel)
-                if smverbose:
-                    print("Inner checking " + s.src + " vs: " + str(ipsel))
-                if ipaddress.ip_address(s.src) in ipsel:
-                    mbranch="4"
-                    matches=True
-                    thesel=s.src
-                if not matches and smverbose:
-                    print("Inner checking " + s.dst + " vs: " + str(ipsel))
-                if not matches and ipaddress.ip_address(s.dst) in ipsel:
-                    mbranch="5"
-                    matches=True
-                    thesel=s.dst
-                if matches:
-                    break
-    if smverbose:
-        print("Checked " + str(s.sess_id) +  " vs. " + str(sels) + " result: " + str(matches) + " " + thesel + " branch:" + mbranch)
-    return matches,thesel
-
-
 # heatmap stuff - not currently used, go check out URL below if thinking of putting it back in
 # taken from https://stackoverflow.com/questions/2369492/generate-a-heatmap-in-matplotlib-using-a-scatter-data-set
 def myplot(x, y, s, bins=1000):
@@ -112,7 +54,7 @@ def check_fod(onename,flist,recurse):
     # if onename is a directory get all '*.pcap[number]' file names therin
     if os.path.isdir(onename):
         pass
-        tfiles = [f for f in os.listdir(onename) if re.match(r'.*\.pca(p|p[0-9])$', f)]
+        tfiles = [f for f in os.listdir(onename) if re.match(r'.*\.(pca(p|p[0-9])|pcapng)$', f)]
         if len(tfiles)!=0:
             for t in tfiles:
                 flist.add(onename+"/"+t)
@@ -157,8 +99,37 @@ argparser.add_argument('-v','--verbose',
 argparser.add_argument('-e','--exchanges',
                     help='anaylse exchanges by time',
                     action='store_true')
+argparser.add_argument('-x','--exchange-format',
+                    dest='exchange_format',
+                    choices=['jsonl','csv'],
+                    default='jsonl',
+                    help='write exchanges (with -e) as JSON Lines (default) or CSV')
+argparser.add_argument('-o','--exchange-file',
+                    dest='exchange_file',
+                    default='-',
+                    help='file for exchanges (with -e), default is stdout')
+argparser.add_argument('-p','--parser',
+                    dest='parser',
+                    choices=['pyshark','native'],
+                    default='pyshark',
+                    help='pcap parser: "pyshark" (default, via tshark) or "native" (quicker)')
+argparser.add_argument('-t','--idle-timeout',
+                    type=float, dest='idle_timeout',
+                    help='stream sessions, ending each after both sides Alert or <num> s idle, to bound memory use (not with -j or -C)')
+argparser.add_argument('-j','--jobs',
+                    type=int, dest='jobs', default=1,
+                    help='number of pcap files to parse in parallel (default: 1)')
+argparser.add_argument('-C','--cache-dir',
+                    dest='cache_dir',
+                    help='keep parsed sessions in this directory and re-use them for unchanged pcaps')
 args=argparser.parse_args()
 
+# streaming goes one file at a time and doesn't hold on to sessions
+# so there's nothing to parallelise or cache
+if args.idle_timeout is not None and (args.jobs!=1 or args.cache_dir is not None):
+    print(sys.argv[0]+ ": Can't use -j or -C with -t - exiting")
+    sys.exit(1)
+
 if args.fodname is not None:
     fodname=args.fodname
 
@@ -185,6 +156,11 @@ if args.selectors is not None:
     if args.verbose:
         print("Selectors set: " + str(selectors))
 
+# compile the prefixes once for selector_match, see PrefixMatcher
+selmatcher=None
+if type(selectors)==list:
+    selmatcher=PrefixMatcher(selectors)
+
 # make list of file names to process
 flist=set()
 # input string could be space sep list of file or directory names
@@ -205,11 +181,6 @@ if args.verbose:
     print("Reading pcaps...")
     print(flist)
 
-sessions=[]
-analyse_pcaps(flist,sessions,args.verbose)
-if args.verbose:
-    print("Found " + str(len(sessions)) + " sessions.\n")
-
 # Check if file exists with IPs to ignore...
 # Mostly this is for ignoring DNS queries/answers that tend to  
 # muck up our noise/music and that'd only be seen from some
@@ -231,26 +202,41 @@ if args.verbose:
     else:
         print("Addresses to ignore: " + str(block_arr))
 
-# point for scatter plot
-cxpoints=[]
-cypoints=[]
-sxpoints=[]
-sypoints=[]
-# count of sessions processed
+# point for scatter plot, same array types as the sessions use so
+# we can just append those
+cxpoints=array(DELAY_TYPE)
+cypoints=array(PSIZE_TYPE)
+sxpoints=array(DELAY_TYPE)
+sypoints=array(PSIZE_TYPE)
+# count of sessions found and processed
+nfound=0
 nsessions=0
-# group our sessions according to selector
-# and keep tabs on overall duration of sessions in groups
-for s in sessions:
+# exchanges, if asked for, are written as we figure 'em out
+xwriter=None
+xfile=None
+if args.exchanges:
+    if args.exchange_file=='-':
+        xfile=sys.stdout
+    else:
+        xfile=open(args.exchange_file,'w',newline='')
+    xwriter=ExchangeWriter(xfile,args.exchange_format)
+
+def do_session(s):
+    '''
+    gather the numbers for one session, we do this for each session
+    in turn, or as each finishes if we're streaming
+    '''
+    global nsessions,cxpoints,cypoints,sxpoints,sypoints
     if s.dst in block_arr or s.src in block_arr:
         if args.verbose:
             print("Ignoring blocked session: " + s.src + "->" + s.dst)
-        continue
+        return
     if type(selectors)!= str:
-        matches,sel=selector_match(s,selectors)
+        matches,sel=selector_match(s,selectors,pm=selmatcher)
         if not matches:
             if args.verbose:
                 print("Skipping session: " + s.src + "->" + s.dst)
-        continue
+        return
     # count 'em
     nsessions += 1
     # numbers for each session:
@@ -265,7 +251,7 @@ for s in sessions:
     s2cc=len(s.d_delays)
     duration=0
     if c2sc != 0 or s2cc !=0: 
-        duration=max(s.s_delays+s.d_delays)
+        duration=max(max(s.s_delays,default=0),max(s.d_delays,default=0))
     min_pdu=0
     if s.min_pdu!=sys.maxsize:
         min_pdu=s.min_pdu
@@ -281,10 +267,41 @@ for s in sessions:
         sxpoints+=s.d_delays
         sypoints+=s.d_psizes
 
-# figure out cadence (the timing of client/server interactions)
-if args.exchanges is not None and args.exchanges == True:
-    ints=analyse_cadence(sessions)
-    print(ints)
+def stream_session(s):
+    '''
+    callback for analyse_pcaps when streaming, after this we're
+    done with s
+    '''
+    global nfound
+    nfound += 1
+    # figure out cadence (the timing of client/server interactions)
+    if xwriter is not None:
+        xwriter.write_all(analyse_cadence_np([s]))
+    do_session(s)
+
+if args.idle_timeout is not None:
+    # sessions are handed to us as they finish and then dropped
+    # so memory doesn't grow with the number of sessions
+    analyse_pcaps(flist,None,args.verbose,args.parser,emit=stream_session,idle_timeout=args.idle_timeout)
+    if args.verbose:
+        print("Found " + str(nfound) + " sessions.\n")
+else:
+    sessions=[]
+    analyse_pcaps(flist,sessions,args.verbose,args.parser,args.jobs,cache_dir=args.cache_dir)
+    if args.verbose:
+        print("Found " + str(len(sessions)) + " sessions.\n")
+    # group our sessions according to selector
+    # and keep tabs on overall duration of sessions in groups
+    for s in sessions:
+        do_session(s)
+    # figure out cadence (the timing of client/server interactions)
+    if xwriter is not None:
+        xwriter.write_all(iter_cadence(sessions))
+
+if xfile is not None and xfile is not sys.stdout:
+    xfile.close()
+    if args.verbose:
+        print("Wrote " + str(xwriter.count) + " exchanges to " + args.exchange_file)
 
 print("Processsed " + str(nsessions) + " TLS sessions")
 
@@ -37,6 +37,20 @@ argparser=argparse.ArgumentParser(description='Basic parse/print some pcaps')
 argparser.add_argument('-f','--file',     
                     dest='fodname',
                     help='PCAP file or direcftory name')
+argparser.add_argument('-p','--parser',
+                    dest='parser',
+                    choices=['pyshark','native'],
+                    default='pyshark',
+                    help='pcap parser: "pyshark" (default, via tshark) or "native" (quicker)')
+argparser.add_argument('-j','--jobs',
+                    type=int, dest='jobs', default=1,
+                    help='number of pcap files to parse in parallel (default: 1)')
+argparser.add_argument('-C','--cache-dir',
+                    dest='cache_dir',
+                    help='keep parsed sessions in this directory and re-use them for unchanged pcaps')
+argparser.add_argument('-o','--output',
+                    dest='outname',
+                    help='write sessions and packets as column arrays to this numpy .npz file instead of printing')
 args=argparser.parse_args()
 
 if args.fodname is not None:
@@ -65,8 +79,11 @@ if len(flist)==0:
 # our array of TLS sessions
 sessions=[]
 
-analyse_pcaps(flist,sessions,False)
+analyse_pcaps(flist,sessions,False,args.parser,args.jobs,cache_dir=args.cache_dir)
 print("Found " + str(len(sessions)) + " sessions.\n")
+if args.outname is not None:
+    export_sessions(sessions,args.outname)
+    sys.exit(0)
 for s in sessions:
     print(s)
     time.sleep(0.01) 
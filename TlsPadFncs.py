@@ -25,13 +25,26 @@
 # https://www.iana.org/assignments/tls-parameters/tls-parameters.xhtml
 
 import traceback
-import os,sys,argparse,re,random,time
+import os,sys,argparse,re,random,time,datetime,ipaddress
+import multiprocessing,collections,collections.abc
+import hashlib,pickle,json,csv
+from array import array
 import pyshark
 
+# our own (non-tshark) pcap reading
+from pcapreader import *
+
 # structures/function to handle (the bits wer care about from) a TLS session
 # given we may have large inputs, we wanna be less wasterful of memory
 # so we'll use classes for this
 
+# per-packet sizes and delays are kept in compact arrays rather than lists
+# of python ints/floats, sizes are TLS record lengths which are 16 bits
+# on the wire so 'H' holds them all (and anything bigger would make
+# append raise OverflowError rather than wrap)
+PSIZE_TYPE='H'
+DELAY_TYPE='d'
+
 class TLSSession():
     __slots__ = [ 
             'sess_id',
@@ -53,13 +66,17 @@ class TLSSession():
             'min_pdu',
             'max_pdu',
             'num_sizes',
+            'sizes_seen',
             's_psizes',
             's_delays',
             'd_psizes',
             'd_delays',
             'channel',
             'instrument',
-            'sortstr'
+            'sortstr',
+            's_alert',
+            'd_alert',
+            'last_seen'
             ]
 
     def __init__(self,fname='',ver='',stime=0,tstamp='0',src='',sport='',dst='',dport=''):
@@ -82,13 +99,17 @@ class TLSSession():
         self.min_pdu=sys.maxsize 
         self.max_pdu=0
         self.num_sizes=0
-        self.s_psizes=[] # list of APDU sizes from src, 0 is 1st, 1 2nd seen etc.
-        self.s_delays=[] # list of relative time offsets from session start
-        self.d_psizes=[] # list of APDU sizes from dst, 0 is 1st, 1 2nd seen etc.
-        self.d_delays=[] # list of relative time offsets from session start
+        self.sizes_seen=set() # distinct APDU sizes, both directions
+        self.s_psizes=array(PSIZE_TYPE) # APDU sizes from src, 0 is 1st, 1 2nd seen etc.
+        self.s_delays=array(DELAY_TYPE) # relative time offsets (ms) from session start
+        self.d_psizes=array(PSIZE_TYPE) # APDU sizes from dst, 0 is 1st, 1 2nd seen etc.
+        self.d_delays=array(DELAY_TYPE) # relative time offsets (ms) from session start
         self.channel=0 # used in Tls2Music only (so far)
         self.instrument=0 # used in Tls2Music only (so far)
         self.sortstr=src+":"+sport+"->"+dst+":"+dport
+        self.s_alert=False # seen an Alert from src
+        self.d_alert=False # seen an Alert from dst
+        self.last_seen=self.timestamp # time of latest TLS record
 
     def __str__(self):
         return "ID: " + str(self.sess_id) + " V:" + self.version + "\n" + \
@@ -100,9 +121,9 @@ class TLSSession():
                 "\t" + "Cert size: " +  str(self.certsize) + " CV size (proxy): " + str(self.cvsize) + "\n" +  \
                 "\t" + "Min PDU: " + str(self.min_pdu) + " Max PDU: " + str(self.max_pdu) + " Num sizes: " + str(self.num_sizes) + "\n" + \
                 "\t" + "number tx'd: " + str(len(self.s_psizes)) + " rx'd: " + str(len(self.d_psizes)) + "\n" + \
-                "\t" + "source packet sizes: " + str(self.s_psizes) + "\n"+ \
+                "\t" + "source packet sizes: " + str(self.s_psizes.tolist()) + "\n"+ \
                 "\t" + "source packet times: " + str(["%.3f" % v for v in self.s_delays]) + "\n" + \
-                "\t" + "dest packet sizes: " + str(self.d_psizes) + "\n" + \
+                "\t" + "dest packet sizes: " + str(self.d_psizes.tolist()) + "\n" + \
                 "\t" + "dest packet times: " + str(["%.3f" % v for v in self.d_delays]) + "\n"  + \
                 "\t" + "channel " + str(self.channel) + " instrument: " + str(self.instrument)
 
@@ -130,9 +151,10 @@ class TLSSession():
             self.min_pdu=isize
         if isize > self.max_pdu:
             self.max_pdu=isize
-        # probably v. slow but we don't get huge numbers of packets/session
-        # so likely not a big deal
-        self.num_sizes=len(set(self.s_psizes+self.d_psizes))
+        # keep track of distinct sizes as we go, rebuilding a set from
+        # both lists for each packet gets slow for long sessions
+        self.sizes_seen.add(isize)
+        self.num_sizes=len(self.sizes_seen)
     
     def note_chsize(self,cs):
         self.chsize=cs
@@ -140,202 +162,628 @@ class TLSSession():
     def note_shsize(self,ss):
         self.shsize=ss
 
-    def note_end(self,pkttime):
+    def note_end(self,pkttime,src=None):
         self.end_time=pkttime
+        # note which side(s) have sent an Alert, if we know
+        if src==True:
+            self.s_alert=True
+        elif src==False:
+            self.d_alert=True
 
 # used for sorting sessions
 def get_sortstr(s):
     return s.sortstr
 
-def sess_find(fname,sessions,ver,ptime,ptstamp,src,sport,dst,dport):
+def flow_key(fname,src,sport,dst,dport):
+    '''
+    key for our flow table, the same for both directions of a flow
+    '''
+    a=(src,sport)
+    b=(dst,dport)
+    if b<a:
+        a,b=b,a
+    return (fname,a,b)
+
+def sess_find(fname,sessions,ver,ptime,ptstamp,src,sport,dst,dport,flows=None):
     #print ("Checking for " + src + ":" + sport + " to/from " + dst + ":" + dport + "|")
-    for s in sessions:
-        #print("Considering: " + str(s))
-        if s.fname==fname and s.src==dst and s.sport==dport and s.dst==src and s.dport==sport:
-            #print("Matched reverse")
-            return s
-        elif s.fname==fname and s.src==src and s.sport==sport and s.dst==dst and s.dport==dport:
-            #print("Matched forward")
+    # if we're given a flow table (dict) use that, rather than a linear
+    # search through all sessions for every packet
+    if flows is not None:
+        key=flow_key(fname,src,sport,dst,dport)
+        s=flows.get(key)
+        if s is not None:
             return s
+    else:
+        for s in sessions:
+            #print("Considering: " + str(s))
+            if s.fname==fname and s.src==dst and s.sport==dport and s.dst==src and s.dport==sport:
+                #print("Matched reverse")
+                return s
+            elif s.fname==fname and s.src==src and s.sport==sport and s.dst==dst and s.dport==dport:
+                #print("Matched forward")
+                return s
     # otherwise make a new one
     # TODO: extend/parameterise this set of known server ports sometime
     if dport=="443" or dport=="853" or dport=="993":
         #sys.stderr.write("New Session option 1: " + sport + "->" + dport + "\n") 
         s=TLSSession(fname,ver,ptime,ptstamp,src,sport,dst,dport)
-        sessions.append(s)
-        return s
     elif sport=="443" or sport=="853" or sport=="993":
         #sys.stderr.write("New Session option 2: " + sport + "->" + dport + "\n") 
         s=TLSSession(fname,ver,ptime,ptstamp,dst,dport,src,sport)
-        sessions.append(s)
-        return s
     else:
         # take 'em as they come
         s=TLSSession(fname,ver,ptime,ptstamp,src,sport,dst,dport)
         #print("New Session option 3: " + sport + "->" + dport + "Session ID: " + str(s.sess_id))
+    if sessions is not None:
         sessions.append(s)
-        return s
+    if flows is not None:
+        flows[key]=s
+    return s
+
+class LiveSessions():
+    '''
+    When streaming, this holds the sessions still in progress (in the
+    flow table used by sess_find) and hands finished ones to the emit
+    callback, after which we forget 'em. A session is finished when
+    both sides have sent an Alert, or if idle_timeout (seconds) is set,
+    when we've seen nothing for it for that long.
+    '''
+    __slots__ = [
+            'flows', # flow table for sess_find
+            'lru', # live sessions, least recently seen first
+            'emit', # callback for finished sessions
+            'idle_timeout',
+            ]
+
+    def __init__(self,emit,idle_timeout=None):
+        self.flows={}
+        self.lru=collections.OrderedDict()
+        self.emit=emit
+        self.idle_timeout=idle_timeout
+
+    def touch(self,s,now):
+        '''
+        call after each TLS record for session s, now is the record time
+        '''
+        s.last_seen=now
+        key=flow_key(s.fname,s.src,s.sport,s.dst,s.dport)
+        if s.s_alert and s.d_alert:
+            self.finish(key)
+            return
+        if self.idle_timeout is None:
+            return
+        self.lru[key]=s
+        self.lru.move_to_end(key)
+        # evict anyone who's been idle too long
+        while len(self.lru)>0:
+            okey,olds=next(iter(self.lru.items()))
+            if now-olds.last_seen<=self.idle_timeout:
+                break
+            self.finish(okey)
+
+    def finish(self,key):
+        s=self.flows.pop(key,None)
+        self.lru.pop(key,None)
+        if s is not None:
+            self.emit(s)
+
+    def flush(self):
+        '''
+        emit everything still live, e.g. at the end of a file
+        '''
+        for key in list(self.flows):
+            self.finish(key)
+
+# bump this whenever a change to either parser or to TLSSession would
+# make previously cached sessions wrong, that makes all old cache
+# entries stale
+PARSER_VERSION=1
+CACHE_MAGIC=b'TLSPADCACHE1\n'
+HASH_BLOCK=1<<20
+
+def file_hash(fname):
+    '''
+    sha256 of a file's content, as a hex string
+    '''
+    h=hashlib.sha256()
+    with open(fname,'rb') as f:
+        while True:
+            b=f.read(HASH_BLOCK)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+def cache_path(cache_dir,fname,engine):
+    '''
+    where we keep cached sessions for fname, one file per input
+    file and parser engine
+    '''
+    pkey=hashlib.sha256(os.path.abspath(fname).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(cache_dir,pkey+"-"+engine+".tlscache")
+
+def _cache_key(fname,engine):
+    st=os.stat(fname)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'engine': engine, 'version': PARSER_VERSION }
+
+def cache_load(cache_dir,fname,engine):
+    '''
+    return the list of cached sessions for fname, or None if we don't
+    have a good cache entry (missing, stale or corrupt)
+    the header is checked first: size and parser engine/version have
+    to match, then if mtime does too we take the entry without reading
+    the pcap at all (a hit shouldn't cost as much as a parse), if only
+    mtime differs (e.g. the file was copied or touched) we hash the pcap
+    and use the entry if the content's the same, noting the new mtime
+    so we don't hash it again next time
+    '''
+    cpath=cache_path(cache_dir,fname,engine)
+    if not os.path.isfile(cpath):
+        return None
+    try:
+        with open(cpath,'rb') as f:
+            if f.read(len(CACHE_MAGIC))!=CACHE_MAGIC:
+                return None
+            hdr=pickle.load(f)
+            key=_cache_key(fname,engine)
+            for k in key:
+                if k!='mtime' and hdr.get(k)!=key[k]:
+                    return None
+            payload=f.read()
+        if hashlib.sha256(payload).hexdigest()!=hdr['payload_hash']:
+            return None
+        touched=hdr.get('mtime')!=key['mtime']
+        if touched and file_hash(fname)!=hdr['hash']:
+            return None
+        sessions=pickle.loads(payload)
+    except Exception:
+        # truncated/garbled entry, we'll just re-parse and overwrite
+        return None
+    if touched:
+        hdr['mtime']=key['mtime']
+        try:
+            _cache_write(cpath,hdr,payload)
+        except Exception:
+            pass
+    return sessions
+
+def _cache_write(cpath,hdr,payload):
+    # via a temporary file and a rename so a crash or concurrent run
+    # can't leave a half-written entry
+    tmpname=cpath+"."+str(os.getpid())+".tmp"
+    with open(tmpname,'wb') as f:
+        f.write(CACHE_MAGIC)
+        pickle.dump(hdr,f,protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(payload)
+    os.replace(tmpname,cpath)
+
+def cache_save(cache_dir,fname,engine,sessions):
+    '''
+    write sessions for fname to the cache (see _cache_write)
+    '''
+    os.makedirs(cache_dir,exist_ok=True)
+    cpath=cache_path(cache_dir,fname,engine)
+    payload=pickle.dumps(sessions,protocol=pickle.HIGHEST_PROTOCOL)
+    hdr=_cache_key(fname,engine)
+    hdr['hash']=file_hash(fname)
+    hdr['payload_hash']=hashlib.sha256(payload).hexdigest()
+    hdr['fname']=fname
+    _cache_write(cpath,hdr,payload)
 
-def analyse_pcaps(flist,sessions,verbose):
+def analyse_pcap(fname,sessions,engine='pyshark',cache_dir=None):
+    '''
+    Parse one file with the chosen engine, adding its sessions to sessions
+    If cache_dir is set we first look there for sessions from an earlier
+    run on the same (unchanged) file and so avoid parsing entirely, and
+    if not found we save what we parse for next time
+    '''
+    if cache_dir is None:
+        if engine=='native':
+            analyse_pcap_native(fname,sessions)
+        else:
+            analyse_pcap_pyshark(fname,sessions)
+        return
+    fsessions=cache_load(cache_dir,fname,engine)
+    if fsessions is not None:
+        sessions.extend(fsessions)
+        return
+    fsessions=[]
+    try:
+        if engine=='native':
+            analyse_pcap_native(fname,fsessions)
+        else:
+            analyse_pcap_pyshark(fname,fsessions)
+    except:
+        # keep what we got, as we would uncached, but don't cache it
+        sessions.extend(fsessions)
+        raise
+    sessions.extend(fsessions)
+    try:
+        cache_save(cache_dir,fname,engine,fsessions)
+    except Exception as e:
+        sys.stderr.write("Can't write cache for " + fname + ": " + str(e) + "\n")
+
+def _analyse_one_pcap(job):
+    '''
+    Worker for parallel analyse_pcaps: job is (fname,engine,cache_dir), we
+    return the sessions found in that file plus the text of any exception (as
+    we'd otherwise have written to stderr) or None
+    '''
+    fname,engine,cache_dir=job
+    sessions=[]
+    err=None
+    try:
+        analyse_pcap(fname,sessions,engine,cache_dir)
+    except Exception as e:
+        err=str(traceback.format_exc()) + "Exception: " + str(e) + "\n"
+    return sessions,err
+
+def fork_pool(processes,initializer=None):
+    '''
+    A process pool whose workers are forked, our scripts do all their
+    work at the top level with no __main__ guard, so a spawned (macOS)
+    or forkserver'd (linux from python 3.14) worker would re-import the
+    script and re-run the lot, forked workers just carry on from here
+    '''
+    return multiprocessing.get_context('fork').Pool(processes=processes,initializer=initializer)
+
+def analyse_pcaps(flist,sessions,verbose,engine='pyshark',jobs=1,emit=None,idle_timeout=None,cache_dir=None):
     # iterate through each file, gathering our stats
+    # engine is either 'pyshark' (the reference, via tshark) or 'native'
+    # (our own pcap/pcapng reader from pcapreader.py, much quicker)
+    # sessions never span files so with jobs>1 we parse files in a pool
+    # of processes and add each file's sessions in flist order
+    # if emit is given we stream instead: sessions are passed to emit(s)
+    # as they finish (see LiveSessions) and not added to sessions, that
+    # is done one file at a time so jobs is ignored
+    # if cache_dir is given, sessions parsed from each file are kept there
+    # and re-used if the file is unchanged (see analyse_pcap), streaming
+    # doesn't use the cache as we don't hold on to the sessions
+    if emit is not None:
+        for fname in flist:
+            if verbose:
+                print("Processing " + fname)
+            live=LiveSessions(emit,idle_timeout)
+            try:
+                if engine=='native':
+                    analyse_pcap_native(fname,None,live)
+                else:
+                    analyse_pcap_pyshark(fname,None,live)
+            except Exception as e:
+                sys.stderr.write(str(traceback.format_exc()))
+                sys.stderr.write("Exception: " + str(e) + "\n")
+            live.flush()
+        return
+    if jobs is not None and jobs>1 and len(flist)>1:
+        flist=list(flist)
+        # workers re-seed so forked children don't all make the same sess_ids
+        with fork_pool(jobs,initializer=random.seed) as pool:
+            results=pool.imap(_analyse_one_pcap,[(fname,engine,cache_dir) for fname in flist])
+            for fname,(fsessions,err) in zip(flist,results):
+                if verbose:
+                    print("Processed " + fname)
+                if err is not None:
+                    sys.stderr.write(err)
+                sessions.extend(fsessions)
+        return
     for fname in flist:
         if verbose:
             print("Processing " + fname)
         try:
-            f = pyshark.FileCapture(fname,display_filter='ssl')
-            chtime=0
-            for pkt in f:
-                src=""
-                if 'ip' in pkt:
-                    src=pkt.ip.src
-                    dst=pkt.ip.dst
-                elif 'ipv6' in pkt:
-                    src=pkt.ipv6.src
-                    dst=pkt.ipv6.dst
-                else:
-                    sys.stderr.write("No sender!\n");
-                    sys.stderr.write(str(dir(pkt))+"\n")
-                    sys.stderr.write(str(pkt)+"\n")
-                    continue
-                if 'tcp' in pkt:
-                    dport=pkt.tcp.dstport
-                    sport=pkt.tcp.srcport
-                else:
-                    sys.stderr.write("Not a TCP packet!"+"\n")
-                    sys.stderr.write(str(dir(pkt))+"\n")
-                    sys.stderr.write(str(pkt)+"\n")
-                    continue
-                if 'ssl' not in pkt:
-                    #print ("Skipping non SSL packet from " + src)
-                    continue
-                if not (hasattr(pkt.ssl,'record_content_type') or hasattr(pkt.ssl,'record_opaque_type')):
-                    #print("Skipping SSL packet with nonsense content")
-                    continue
+            analyse_pcap(fname,sessions,engine,cache_dir)
+        except Exception as e:
+            sys.stderr.write(str(traceback.format_exc()))
+            sys.stderr.write("Exception: " + str(e) + "\n")
+
+def analyse_pcap_pyshark(fname,sessions,live=None):
+    f = pyshark.FileCapture(fname,display_filter='ssl')
+    chtime=0
+    # flow table for sess_find, sessions don't span files so per-file is fine
+    flows={}
+    if live is not None:
+        flows=live.flows
+    for pkt in f:
+        src=""
+        if 'ip' in pkt:
+            src=pkt.ip.src
+            dst=pkt.ip.dst
+        elif 'ipv6' in pkt:
+            src=pkt.ipv6.src
+            dst=pkt.ipv6.dst
+        else:
+            sys.stderr.write("No sender!\n");
+            sys.stderr.write(str(dir(pkt))+"\n")
+            sys.stderr.write(str(pkt)+"\n")
+            continue
+        if 'tcp' in pkt:
+            dport=pkt.tcp.dstport
+            sport=pkt.tcp.srcport
+        else:
+            sys.stderr.write("Not a TCP packet!"+"\n")
+            sys.stderr.write(str(dir(pkt))+"\n")
+            sys.stderr.write(str(pkt)+"\n")
+            continue
+        if 'ssl' not in pkt:
+            #print ("Skipping non SSL packet from " + src)
+            continue
+        if not (hasattr(pkt.ssl,'record_content_type') or hasattr(pkt.ssl,'record_opaque_type')):
+            #print("Skipping SSL packet with nonsense content")
+            continue
     
-                ver='unknown'
-                if hasattr(pkt.ssl,'record_version'):
-                    ver=pkt.ssl.record_version
+        ver='unknown'
+        if hasattr(pkt.ssl,'record_version'):
+            ver=pkt.ssl.record_version
     
-                # see if this is a known session or not
-                this_sess=sess_find(fname,sessions,ver,pkt.sniff_time,pkt.sniff_timestamp,src,sport,dst,dport)
+        # see if this is a known session or not
+        this_sess=sess_find(fname,sessions,ver,pkt.sniff_time,pkt.sniff_timestamp,src,sport,dst,dport,flows)
     
-                if hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="20":
-                    # print("ChangeCipherSpec")
+        if hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="20":
+            # print("ChangeCipherSpec")
+            pass
+        elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="21":
+            # TODO: if we get two of these, one from each side, that may be good reason to
+            # think that's the end of this TLS session, but maybe more checking is
+            # needed, we'll see...
+            # print("EncryptedAlert at " + str(pkt.sniff_time) + " for: " + str(this_sess))
+            this_sess.note_end(pkt.sniff_time,(this_sess.src==src and this_sess.sport==sport))
+            pass
+        elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="22":
+            # handshake
+            if hasattr(pkt.ssl,'handshake_type'):
+                if pkt.ssl.handshake_type=="1":
+                    #print("ClientHello for " + str(this_sess.sess_id))
+                    this_sess.note_chsize(pkt.ssl.record_length)
+                    this_sess.chtime=pkt.sniff_time
+                    pass
+                elif pkt.ssl.handshake_type=="2":
+                    #print("ServerHello")
+                    this_sess.note_shsize(pkt.ssl.record_length)
+                    if this_sess.chtime==0:
+                        this_sess.rttest=-1
+                    else:
+                        td=pkt.sniff_time-this_sess.chtime
+                        this_sess.rttest=int(td.total_seconds()*1000)
                     pass
-                elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="21":
-                    # TODO: if we get two of these, one from each side, that may be good reason to
-                    # think that's the end of this TLS session, but maybe more checking is
-                    # needed, we'll see...
-                    # print("EncryptedAlert at " + str(pkt.sniff_time) + " for: " + str(this_sess))
-                    this_sess.note_end(pkt.sniff_time)
+                elif pkt.ssl.handshake_type=="4":
+                    #print("NewSessionTicket")
                     pass
-                elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="22":
-                    # handshake
-                    if hasattr(pkt.ssl,'handshake_type'):
-                        if pkt.ssl.handshake_type=="1":
-                            #print("ClientHello for " + str(this_sess.sess_id))
-                            this_sess.note_chsize(pkt.ssl.record_length)
-                            this_sess.chtime=pkt.sniff_time
-                            pass
-                        elif pkt.ssl.handshake_type=="2":
-                            #print("ServerHello")
-                            this_sess.note_shsize(pkt.ssl.record_length)
-                            if this_sess.chtime==0:
-                                this_sess.rttest=-1
-                            else:
-                                td=pkt.sniff_time-this_sess.chtime
-                                this_sess.rttest=int(td.total_seconds()*1000)
-                            pass
-                        elif pkt.ssl.handshake_type=="4":
-                            #print("NewSessionTicket")
-                            pass
-                        elif pkt.ssl.handshake_type=="11":
-                            #print("Certificate")
-                            this_sess.certsize=pkt.ssl.record_length
-                            # If RSA:
-                            # Use the server cert modulus size as a proxy for what
-                            # would be the size of a TLS1.3 CertificateVerify
-                            # Modulus format here is of the form "00:aa:bb..."
-                            # So we want to loose the colons (1/3 of length)
-                            # then divide by 2 to get octets
-                            # then add 10 which'd be the overhead for a TLS1.3 CertificateVerify
-                            # So bottom line is divide by 3, then add 10
-                            # and "//" is integer divide for python 3
-                            if hasattr(pkt.ssl,'pkcs1_modulus'):
-                                mlen=len(pkt.ssl.pkcs1_modulus)
-                                mlen=(mlen//3)+10
-                                if this_sess.cvsize==0:
-                                    this_sess.cvsize=mlen
-                                else:
-                                    # Don't think this should happen, but who knows...
-                                    # If it does, better we know
-                                    sys.stderr.write("Re-setting cvsize for " + str(this_sess.sess_id) + \
-                                        " from: " + str(this_sess.cvsize) + \
-                                        " to: " + str(mlen) + "\n" )
-                                    this_sess.cvsize=mlen
-                            elif hasattr(pkt.ssl,'pkcs1_ecparameters') and hasattr(pkt.ssl,'x509af_subjectpublickey'):
-                                # same encoding as above
-                                pklen=len(pkt.ssl.x509af_subjectpublickey)//3+10
-                                this_sess.cvsize=pklen
-                            else:
-                                sys.stderr.write("No modulus or ECParameters for session: " + str(this_sess.sess_id)+ "\n")
-                                sys.stderr.write(str(dir(pkt.ssl))+ "\n")
-                                sys.stderr.write(str(pkt.ssl)+ "\n")
-                        elif pkt.ssl.handshake_type=="12":
-                            #print("ServerKeyExchange")
-                            pass
-                        elif pkt.ssl.handshake_type=="14":
-                            #print("ServerHelloDone")
-                            pass
-                        elif pkt.ssl.handshake_type=="16":
-                            #print("ClientKeyExchange")
-                            pass
-                        elif pkt.ssl.handshake_type=="15":
-                            #print("CertificateVerify")
-                            this_sess.cvsize=pkt.ssl.record_length
-                            pass
-                        elif pkt.ssl.handshake_type=="22":
-                            #print("CertificateStatus")
-                            pass
+                elif pkt.ssl.handshake_type=="11":
+                    #print("Certificate")
+                    this_sess.certsize=pkt.ssl.record_length
+                    # If RSA:
+                    # Use the server cert modulus size as a proxy for what
+                    # would be the size of a TLS1.3 CertificateVerify
+                    # Modulus format here is of the form "00:aa:bb..."
+                    # So we want to loose the colons (1/3 of length)
+                    # then divide by 2 to get octets
+                    # then add 10 which'd be the overhead for a TLS1.3 CertificateVerify
+                    # So bottom line is divide by 3, then add 10
+                    # and "//" is integer divide for python 3
+                    if hasattr(pkt.ssl,'pkcs1_modulus'):
+                        mlen=len(pkt.ssl.pkcs1_modulus)
+                        mlen=(mlen//3)+10
+                        if this_sess.cvsize==0:
+                            this_sess.cvsize=mlen
                         else:
-                            sys.stderr.write("Handshake: " + pkt.ssl.handshake_type + "\n")
-                            sys.stderr.write(src+":"+sport+"->"+dst+":"+dport + "\n")
-                            sys.stderr.write(str(dir(pkt.ssl)) + "\n")
-                            sys.stderr.write(str(pkt.ssl) + "\n")
-                    else:
-                        # This should just be encrypted Finished messages in TLS1.2
-                        # but can be others in TLS1.3 - we'll ignore 'em anyway
-                        # (for now:-)
-                        #sys.stderr.write("Weird Handsshake: " + "\n")
-                        #sys.stderr.write(src+":"+sport+"->"+dst+":"+dport + "\n")
-                        #sys.stderr.write(str(dir(pkt.ssl)) + "\n")
-                        #sys.stderr.write(str(pkt.ssl) + "\n")
-                        pass
-                elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="23":
-                    # application data, count it!
-                    this_sess.add_apdu(pkt.ssl.record_length,pkt.sniff_time,pkt.sniff_timestamp,(this_sess.src==src and this_sess.sport==sport))
-                elif hasattr(pkt.ssl,'record_opaque_type') and pkt.ssl.record_opaque_type=="23":
-                    # also application data, count it! why the diference I wonder?
-                    if not hasattr(pkt.ssl,'change_cipher_spec'):
-                        this_sess.add_apdu(pkt.ssl.record_length,pkt.sniff_time,pkt.sniff_timestamp,(this_sess.src==src and this_sess.sport==sport))
+                            # Don't think this should happen, but who knows...
+                            # If it does, better we know
+                            sys.stderr.write("Re-setting cvsize for " + str(this_sess.sess_id) + \
+                                " from: " + str(this_sess.cvsize) + \
+                                " to: " + str(mlen) + "\n" )
+                            this_sess.cvsize=mlen
+                    elif hasattr(pkt.ssl,'pkcs1_ecparameters') and hasattr(pkt.ssl,'x509af_subjectpublickey'):
+                        # same encoding as above
+                        pklen=len(pkt.ssl.x509af_subjectpublickey)//3+10
+                        this_sess.cvsize=pklen
                     else:
-                        #print("CCS")
-                        pass
-                elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="24":
-                    # print("Heartbeat!")
+                        sys.stderr.write("No modulus or ECParameters for session: " + str(this_sess.sess_id)+ "\n")
+                        sys.stderr.write(str(dir(pkt.ssl))+ "\n")
+                        sys.stderr.write(str(pkt.ssl)+ "\n")
+                elif pkt.ssl.handshake_type=="12":
+                    #print("ServerKeyExchange")
+                    pass
+                elif pkt.ssl.handshake_type=="14":
+                    #print("ServerHelloDone")
+                    pass
+                elif pkt.ssl.handshake_type=="16":
+                    #print("ClientKeyExchange")
+                    pass
+                elif pkt.ssl.handshake_type=="15":
+                    #print("CertificateVerify")
+                    this_sess.cvsize=pkt.ssl.record_length
+                    pass
+                elif pkt.ssl.handshake_type=="22":
+                    #print("CertificateStatus")
                     pass
                 else:
-                    sys.stderr.write("Unexpected Message: "  + str(this_sess.sess_id) + "\n")
-                    sys.stderr.write(str(dir(pkt.ssl))+"\n")
-                    sys.stderr.write(str(pkt.ssl)+"\n")
-            f.close()
-            # there's occasional (but possibly predictable, not sure) exceptions
-            # from the bowels of tshark, maybe a little sleep with fix...
-            # time.sleep(5) 
-            # nope, didn't work
-        except Exception as e:
-            sys.stderr.write(str(traceback.format_exc()))
-            sys.stderr.write("Exception: " + str(e) + "\n")
+                    sys.stderr.write("Handshake: " + pkt.ssl.handshake_type + "\n")
+                    sys.stderr.write(src+":"+sport+"->"+dst+":"+dport + "\n")
+                    sys.stderr.write(str(dir(pkt.ssl)) + "\n")
+                    sys.stderr.write(str(pkt.ssl) + "\n")
+            else:
+                # This should just be encrypted Finished messages in TLS1.2
+                # but can be others in TLS1.3 - we'll ignore 'em anyway
+                # (for now:-)
+                #sys.stderr.write("Weird Handsshake: " + "\n")
+                #sys.stderr.write(src+":"+sport+"->"+dst+":"+dport + "\n")
+                #sys.stderr.write(str(dir(pkt.ssl)) + "\n")
+                #sys.stderr.write(str(pkt.ssl) + "\n")
+                pass
+        elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="23":
+            # application data, count it!
+            this_sess.add_apdu(pkt.ssl.record_length,pkt.sniff_time,pkt.sniff_timestamp,(this_sess.src==src and this_sess.sport==sport))
+        elif hasattr(pkt.ssl,'record_opaque_type') and pkt.ssl.record_opaque_type=="23":
+            # also application data, count it! why the diference I wonder?
+            if not hasattr(pkt.ssl,'change_cipher_spec'):
+                this_sess.add_apdu(pkt.ssl.record_length,pkt.sniff_time,pkt.sniff_timestamp,(this_sess.src==src and this_sess.sport==sport))
+            else:
+                #print("CCS")
+                pass
+        elif hasattr(pkt.ssl,'record_content_type') and pkt.ssl.record_content_type=="24":
+            # print("Heartbeat!")
+            pass
+        else:
+            sys.stderr.write("Unexpected Message: "  + str(this_sess.sess_id) + "\n")
+            sys.stderr.write(str(dir(pkt.ssl))+"\n")
+            sys.stderr.write(str(pkt.ssl)+"\n")
+        if live is not None:
+            live.touch(this_sess,float(pkt.sniff_timestamp))
+    f.close()
+    # there's occasional (but possibly predictable, not sure) exceptions
+    # from the bowels of tshark, maybe a little sleep with fix...
+    # time.sleep(5) 
+    # nope, didn't work
+
+def analyse_pcap_native(fname,sessions,live=None):
+    '''
+    Same as analyse_pcap_pyshark but using our own pcap/pcapng parsing
+    which avoids tshark entirely. We reassemble TCP per direction and
+    then, as with pyshark, the first TLS record completed in each frame
+    is the one that decides what we note for that frame.
+    '''
+    streams={}
+    flows={}
+    if live is not None:
+        flows=live.flows
+    for linktype,secs,nsecs,data in read_frames(fname):
+        seg=decode_tcp(linktype,data)
+        if seg is None:
+            continue
+        src,dst,sport,dport,seq,flags,payload,plen=seg
+        key=(src,sport,dst,dport)
+        hs=streams.get(key)
+        if hs is None:
+            hs=TLSHalfStream()
+            streams[key]=hs
+        recs=hs.add(seq,flags,payload,plen)
+        if len(recs)==0:
+            continue
+        ctype,rver,rlen,body=recs[0]
+
+        # these are what pyshark would give us
+        sniff_timestamp=str(secs)+"."+("%09d" % nsecs)
+        sniff_time=datetime.datetime.fromtimestamp(float(sniff_timestamp))
+        ver="0x%04x" % rver
+        record_length=str(rlen)
+
+        this_sess=sess_find(fname,sessions,ver,sniff_time,sniff_timestamp,src,sport,dst,dport,flows)
+
+        if ctype==TLS_CCS:
+            pass
+        elif ctype==TLS_ALERT:
+            this_sess.note_end(sniff_time,(this_sess.src==src and this_sess.sport==sport))
+        elif ctype==TLS_HANDSHAKE:
+            # encrypted Finished and the like have no body for us
+            htype=-1
+            if body is not None and len(body)>0:
+                htype=body[0]
+            if htype==1:
+                this_sess.note_chsize(record_length)
+                this_sess.chtime=sniff_time
+            elif htype==2:
+                this_sess.note_shsize(record_length)
+                if this_sess.chtime==0:
+                    this_sess.rttest=-1
+                else:
+                    td=sniff_time-this_sess.chtime
+                    this_sess.rttest=int(td.total_seconds()*1000)
+            elif htype==11:
+                this_sess.certsize=record_length
+                # same CertificateVerify size proxy as in the pyshark
+                # code, which works from wireshark's colon separated
+                # hex strings, so n octets => (3n-1)//3+10
+                kinfo=cert_keyinfo(body)
+                if kinfo is None:
+                    sys.stderr.write("No modulus or ECParameters for session: " + str(this_sess.sess_id)+ "\n")
+                else:
+                    klen=((3*kinfo[1]-1)//3)+10
+                    if kinfo[0]=='rsa' and this_sess.cvsize!=0:
+                        sys.stderr.write("Re-setting cvsize for " + str(this_sess.sess_id) + \
+                            " from: " + str(this_sess.cvsize) + \
+                            " to: " + str(klen) + "\n" )
+                    this_sess.cvsize=klen
+            elif htype==15:
+                this_sess.cvsize=record_length
+            elif htype not in (-1,4,12,14,16,22):
+                sys.stderr.write("Handshake: " + str(htype) + "\n")
+                sys.stderr.write(src+":"+sport+"->"+dst+":"+dport + "\n")
+        elif ctype==TLS_APPDATA:
+            this_sess.add_apdu(record_length,sniff_time,sniff_timestamp,(this_sess.src==src and this_sess.sport==sport))
+        elif ctype==TLS_HEARTBEAT:
+            pass
+        if live is not None:
+            live.touch(this_sess,float(sniff_timestamp))
+
+class Exchange(collections.abc.Mapping):
+    '''
+    One client/server exchange as found by analyse_cadence
+    Rather than copying the times and sizes we just hold on to the session
+    and the index ranges [c2slo:c2shi] and [s2clo:s2chi] into its c2s and
+    s2c packet arrays, which is much smaller when there are millions
+    This can be used as the dict we used to return, with keys: sess_id,
+    fname, dur, rttest, c2st, c2sp, s2ct, s2cp (times are int ms), the
+    lists are made the first time one is asked for and kept after that,
+    as callers tend to index them over and over - so don't change them
+    '''
+    __slots__ = [
+            'sess',
+            'c2slo',
+            'c2shi',
+            's2clo',
+            's2chi',
+            'dur',
+            'rttest',
+            'lists', # (c2st,c2sp,s2ct,s2cp) once made
+            ]
+
+    def __init__(self,sess,c2slo,c2shi,s2clo,s2chi,dur,rttest):
+        self.sess=sess
+        self.c2slo=c2slo
+        self.c2shi=c2shi
+        self.s2clo=s2clo
+        self.s2chi=s2chi
+        self.dur=dur
+        self.rttest=rttest
+        self.lists=None
+
+    def mklists(self):
+        s=self.sess
+        self.lists=(
+                [int(v) for v in s.s_delays[self.c2slo:self.c2shi]],
+                s.s_psizes[self.c2slo:self.c2shi].tolist(),
+                [int(v) for v in s.d_delays[self.s2clo:self.s2chi]],
+                s.d_psizes[self.s2clo:self.s2chi].tolist())
+        return self.lists
+
+    def __getitem__(self,key):
+        if key=="sess_id":
+            return self.sess.sess_id
+        elif key=="fname":
+            return self.sess.fname
+        elif key=="dur":
+            return self.dur
+        elif key=="rttest":
+            return self.rttest
+        elif key in EXCHANGE_LISTS:
+            lists=self.lists
+            if lists is None:
+                lists=self.mklists()
+            return lists[EXCHANGE_LISTS[key]]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(EXCHANGE_FIELDS)
+
+    def __len__(self):
+        return len(EXCHANGE_FIELDS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+# the fields of an exchange, in the order we write them
+EXCHANGE_FIELDS=['sess_id','fname','dur','rttest','c2st','c2sp','s2ct','s2cp']
+# and where the list ones are in Exchange.lists
+EXCHANGE_LISTS={'c2st':0,'c2sp':1,'s2ct':2,'s2cp':3}
 
 def analyse_cadence(sessions):
     interactions=[]
@@ -366,11 +814,8 @@ def analyse_cadence(sessions):
         c2sind=0
         next_c2sd=0
         while c2sind < numc2ss:
-            c2st=[]
-            c2sp=[]
+            c2slo=c2sind
             this_c2sd=s.s_delays[c2sind] 
-            c2st.append(int(this_c2sd))
-            c2sp.append(s.s_psizes[c2sind])
             if (c2sind<(numc2ss-1)):
                 # if there are two c2s messages <10ms apart, we'll assume
                 # that's down to fragmentation or similar and merge 'em
@@ -383,33 +828,403 @@ def analyse_cadence(sessions):
                     diff_c2sd=next_c2sd-this_c2sd
                     if diff_c2sd < rttest:
                         c2sind+=1
-                        c2st.append(int(next_c2sd))
-                        c2sp.append(s.s_psizes[c2sind])
             else:
                 next_c2sd=sys.maxsize
             c2sind+=1
-            # store the sizes and timings of packets 'till the next
-            # c2s time
-            s2ct=[]
-            s2cp=[]
-            exchange={}
+            # note the range of packets 'till the next c2s time
+            s2clo=s2cind
             while s2cind<len(s.d_delays) and s.d_delays[s2cind] < (next_c2sd + rttest):
-                s2ct.append(int(s.d_delays[s2cind]))
-                s2cp.append(s.d_psizes[s2cind])
                 s2cind+=1
-            exchange["sess_id"]=s.sess_id
-            exchange["fname"]=s.fname
-            if len(s2ct) > 0 :
-                exchange["dur"]=s2ct[-1]-this_c2sd
+            if s2cind > s2clo:
+                dur=int(s.d_delays[s2cind-1])-this_c2sd
             else:
-                exchange["dur"]=0
-            exchange["rttest"]=rttest
-            exchange["c2st"]=c2st
-            exchange["c2sp"]=c2sp
-            exchange["s2ct"]=s2ct
-            exchange["s2cp"]=s2cp
+                dur=0
+            exchange=Exchange(s,c2slo,c2sind,s2clo,s2cind,dur,rttest)
             #print(exchange)
             interactions.append(exchange)
     #print(interactions)
     return(interactions)
 
+def analyse_cadence_np(sessions):
+    '''
+    Same as analyse_cadence() (and giving the same exchanges) but working on
+    the delays of all sessions at once with numpy rather than packet by packet
+    c2s packets are merged if within rttest of the 1st packet of the
+    group, and the s2c answers are those up to the next group's start
+    (plus rttest), each of which we find via searchsorted
+    That needs the delays to be in order, for the odd session where time
+    goes backwards we just use analyse_cadence() for that session
+    '''
+    import numpy as np
+    dtype=np.dtype(DELAY_TYPE)
+    # concatenate everything, remembering where each session starts
+    sd=np.concatenate([np.asarray(s.s_delays,dtype=dtype) for s in sessions]+[np.zeros(0,dtype=dtype)])
+    dd=np.concatenate([np.asarray(s.d_delays,dtype=dtype) for s in sessions]+[np.zeros(0,dtype=dtype)])
+    nsess=len(sessions)
+    ns=np.fromiter((len(s.s_delays) for s in sessions),dtype=np.int64,count=nsess)
+    nd=np.fromiter((len(s.d_delays) for s in sessions),dtype=np.int64,count=nsess)
+    soff=np.concatenate(([0],np.cumsum(ns)))
+    doff=np.concatenate(([0],np.cumsum(nd)))
+    rtts=np.fromiter((s.rttest if s.rttest>0 else 10 for s in sessions),dtype=np.int64,count=nsess)
+    ssid=np.repeat(np.arange(nsess),ns)
+    dsid=np.repeat(np.arange(nsess),nd)
+    # sessions where time goes backwards somewhere
+    odd=np.zeros(nsess,dtype=bool)
+    sback=np.nonzero((sd[1:]<sd[:-1]) & (ssid[1:]==ssid[:-1]))[0]
+    odd[ssid[sback]]=True
+    dback=np.nonzero((dd[1:]<dd[:-1]) & (dsid[1:]==dsid[:-1]))[0]
+    odd[dsid[dback]]=True
+    # searchsorted within each session: complex numbers sort by real then
+    # imaginary part so with the session index as the real part and the
+    # delay as the imaginary one, a search can't leave its own session
+    skey=ssid+1j*sd
+    dkey=dsid+1j*dd
+    rtt=rtts[ssid]
+    send=soff[1:][ssid]
+    ks=np.arange(len(sd))
+    # for each c2s packet k, grpend[k] is the index of the 1st later
+    # packet that's >=rttest after it, i.e. where a group starting
+    # at k ends
+    # searchsorted compares with sd[k]+rttest but we need to be exact
+    # about sd[j]-sd[k]<rttest as in analyse_cadence, rounding can
+    # make those differ so nudge any that are off (rarely loops)
+    grpend=np.searchsorted(skey,ssid+1j*(sd+rtt),side='left')
+    grpend=np.maximum(grpend,ks+1)
+    last=max(len(sd)-1,0)
+    while len(sd)>0:
+        back=(grpend>ks+1) & ((sd[grpend-1]-sd)>=rtt)
+        fwd=(grpend<send) & ((sd[np.minimum(grpend,last)]-sd)<rtt)
+        if not back.any() and not fwd.any():
+            break
+        grpend[back]-=1
+        grpend[fwd]+=1
+    # the time of the next c2s after a group starting at k, as the
+    # loop version has it: the 1st packet not merged, or if we ran
+    # off the end while merging, the last one, or if k is the last
+    # then there's no next
+    nexts=sd[np.minimum(grpend,send-1)]
+    nexts[send-1==ks]=float(sys.maxsize)
+    # s2c answers for a group starting at k are those before that
+    # next c2s (+rttest), and never any before the 1st c2s
+    s2cends=np.searchsorted(dkey,ssid+1j*(nexts+rtt),side='left')
+    firsts=soff[:-1][ns>0]
+    s2cstarts=np.zeros(nsess,dtype=np.int64)
+    s2cstarts[ns>0]=np.searchsorted(dkey,ssid[firsts]+1j*sd[firsts],side='left')
+    # within a session those only go forward, other than never going
+    # back before the 1st c2s
+    s2cends=np.maximum(s2cends,s2cstarts[ssid])
+    # duration from a group start to the last s2c answer, with the int()
+    # of the s2c time as the loop version has it, only used if there
+    # are answers
+    durs=np.zeros(len(sd),dtype=dtype)
+    if len(dd)>0:
+        durs=dd.astype(np.int64)[np.maximum(s2cends-1,0)]-sd
+    s2cends=s2cends.tolist()
+    s2cstarts=s2cstarts.tolist()
+    durs=durs.tolist()
+    grpend=grpend.tolist()
+    soff=soff.tolist()
+    interactions=[]
+    for si,s in enumerate(sessions):
+        k=soff[si]
+        numc2ss=soff[si+1]
+        if k==numc2ss:
+            continue
+        if odd[si]:
+            interactions+=analyse_cadence([s])
+            continue
+        rttest=10
+        if s.rttest>0:
+            rttest=s.rttest
+        # walk the groups, each starts where the previous ended
+        # indices here are into the concatenated arrays, so we need
+        # the session's own offsets for the Exchange
+        sbase=k
+        dbase=doff[si]
+        s2cind=s2cstarts[si]
+        while k<numc2ss:
+            e=grpend[k]
+            s2cend=s2cends[k]
+            interactions.append(Exchange(s,k-sbase,e-sbase,s2cind-dbase,s2cend-dbase,
+                durs[k] if s2cend>s2cind else 0,rttest))
+            s2cind=s2cend
+            k=e
+    return(interactions)
+
+
+class PrefixMatcher():
+    '''
+    A compiled list of IP prefixes (v4 and v6 mixed) to match addresses
+    against, as used by selector_match
+    There's a binary trie per IP version where each node holds the lowest
+    index (in the list) of a prefix ending there, walking an address down
+    that gives the 1st prefix in the list containing the address in at
+    most 32 or 128 steps, regardless of how many prefixes we have
+    Answers are also remembered per address string as sessions share IPs
+    '''
+    __slots__ = [
+            'tries',
+            'bad',
+            'found'
+            ]
+
+    def __init__(self,sels):
+        # a node is [child0,child1,index]
+        self.tries={ 4: [None,None,None], 6: [None,None,None] }
+        # index of the 1st selector that's not a prefix, if any, we
+        # only barf about that if we'd have gotten to it in order
+        self.bad=None
+        self.found={}
+        for ind,sel in enumerate(sels):
+            try:
+                net=ipaddress.ip_network(sel)
+            except ValueError:
+                if self.bad is None:
+                    self.bad=ind
+                continue
+            node=self.tries[net.version]
+            nbits=net.max_prefixlen
+            addr=int(net.network_address)
+            for i in range(net.prefixlen):
+                bit=(addr>>(nbits-1-i))&1
+                if node[bit] is None:
+                    node[bit]=[None,None,None]
+                node=node[bit]
+            if node[2] is None:
+                node[2]=ind
+
+    def first(self,addr):
+        '''
+        return the index of the 1st prefix containing addr, or None
+        '''
+        if addr in self.found:
+            return self.found[addr]
+        ip=ipaddress.ip_address(addr)
+        node=self.tries[ip.version]
+        nbits=ip.max_prefixlen
+        a=int(ip)
+        best=node[2]
+        i=0
+        while i<nbits:
+            node=node[(a>>(nbits-1-i))&1]
+            if node is None:
+                break
+            if node[2] is not None and (best is None or node[2]<best):
+                best=node[2]
+            i+=1
+        self.found[addr]=best
+        return best
+
+# compiled selector lists, keyed on the contents of the list we're
+# given, so a list changed in place gets a new one, that's O(prefixes)
+# per call so callers matching lots of sessions should make their own
+# PrefixMatcher once and hand that to selector_match
+matcher_cache={}
+
+def get_matcher(sels):
+    '''
+    return a PrefixMatcher for sels, making it the 1st time we see sels
+    '''
+    key=tuple(sels)
+    m=matcher_cache.get(key)
+    if m is None:
+        m=PrefixMatcher(key)
+        matcher_cache[key]=m
+    return m
+
+def selector_match(s,sels,sl="",pm=None):
+    '''
+    check if TLS session matches selector
+    selector is a (list of) IP prefixes (v4/v6)
+    for a list we return the src (or if not, dst) IP that matches the
+    1st prefix in the list that matches either, pm is a PrefixMatcher
+    made from the list, if not given we use get_matcher
+    '''
+    matches=False
+    thesel=""
+    mbranch="0"
+    #smverbose=args.verbose:
+    smverbose=False
+    if smverbose:
+        print("Checking " + str(s.sess_id) +  " vs. Sels="+str(sels)+" type(sels): " + str(type(sels)) + " sl: " + str(sl))
+        print("src: " + s.src + " dst: " + s.dst)
+    if type(sels)==str and sels=='all': 
+        mbranch="1"
+        matches=True
+        thesel="all"
+    elif type(sels)==str and sels=='src' and sl is not None and sl==s.src: 
+        mbranch="2"
+        matches=True
+        thesel="src"
+    elif type(sels)==str and sels=='dst' and sl is not None and sl==s.dst: 
+        mbranch="3"
+        matches=True
+        thesel="dst"
+    elif type(sels)==list:
+        if sl is not None:
+            if s.src==sl:
+                mbranch="6"
+                matches=True
+                thesel=sl
+            elif s.dst==sl:
+                mbranch="7"
+                matches=True
+                thesel=sl
+        if not matches and len(sels)>0:
+            if pm is None:
+                pm=get_matcher(sels)
+            sind=pm.first(s.src)
+            dind=pm.first(s.dst)
+            if sind is not None and (dind is None or sind<=dind):
+                mbranch="4"
+                ind=sind
+                thesel=s.src
+            elif dind is not None:
+                mbranch="5"
+                ind=dind
+                thesel=s.dst
+            else:
+                ind=len(sels)
+            # as with checking each in turn, a bad prefix before any match
+            # is an error
+            if pm.bad is not None and pm.bad<ind:
+                ipaddress.ip_network(sels[pm.bad])
+            matches=(ind<len(sels))
+    if smverbose:
+        print("Checked " + str(s.sess_id) +  " vs. " + str(sels) + " result: " + str(matches) + " " + thesel + " branch:" + mbranch)
+    return matches,thesel
+
+def killsilence(events, mingap):
+    '''
+    events are midicsv lines:
+        [track,on/off-time,on/off-string,channel,notenum,velocity]
+    in time order (any iterable of those will do)
+    - we want to eliminate any no-change periods >limit ms long by
+    reducing the times accordingly
+    - that zaps both silences and over-long notes, but good enough
+    - a gap gets shrunk by as many mingap steps as it takes to get
+    it down to mingap or less, we work that number out directly
+    rather than a step at a time, so a long gap costs no more than
+    a short one
+    '''
+    if mingap <= 0:
+        raise ValueError('killsilence needs a gap > 0, not: ' + str(mingap))
+    time2remove=0
+    lasttime=0
+    for note in events:
+        t=note[1]-time2remove
+        excess=t-(lasttime+mingap)
+        if excess > 0:
+            # ceiling of excess/mingap
+            steps=-(-excess//mingap)
+            t-=steps*mingap
+            time2remove+=steps*mingap
+        note[1]=t
+        lasttime=t
+    return
+
+# how many sessions iter_cadence hands to analyse_cadence_np at a time
+CADENCE_BATCH=256
+
+def iter_cadence(sessions,batch=CADENCE_BATCH):
+    '''
+    Generator form of analyse_cadence_np, yields the exchanges for each
+    session in turn so callers can write them out as we go rather than
+    holding the lot, sessions can be any iterable (e.g. a generator)
+    We do a batch of sessions at a time to keep the numpy calls worthwhile
+    '''
+    chunk=[]
+    for s in sessions:
+        chunk.append(s)
+        if len(chunk)>=batch:
+            yield from analyse_cadence_np(chunk)
+            chunk=[]
+    if len(chunk)>0:
+        yield from analyse_cadence_np(chunk)
+
+class ExchangeWriter():
+    '''
+    Write exchanges (as from analyse_cadence) to a file one at a time,
+    either as JSON Lines (one object per line) or as CSV where the
+    c2st/c2sp/s2ct/s2cp lists are space separated within their column
+    '''
+    __slots__ = [
+            'f',
+            'fmt',
+            'csvw',
+            'count'
+            ]
+
+    def __init__(self,f,fmt='jsonl'):
+        if fmt not in ('jsonl','csv'):
+            raise ValueError('Bad exchange format: ' + str(fmt))
+        self.f=f
+        self.fmt=fmt
+        self.csvw=None
+        self.count=0
+        if fmt=='csv':
+            self.csvw=csv.writer(f)
+            self.csvw.writerow(EXCHANGE_FIELDS)
+
+    def write(self,x):
+        if self.csvw is not None:
+            row=[]
+            for k in EXCHANGE_FIELDS:
+                v=x[k]
+                if type(v)==list:
+                    v=" ".join(str(i) for i in v)
+                row.append(v)
+            self.csvw.writerow(row)
+        else:
+            self.f.write(json.dumps(dict(x))+"\n")
+        self.count+=1
+
+    def write_all(self,xs):
+        for x in xs:
+            self.write(x)
+
+def export_sessions(sessions,outname):
+    '''
+    Write sessions to a numpy .npz file as two column-wise tables so that
+    bulk analysis can be done without re-parsing or scraping str(s)
+    The sessions table has one row per session in arrays named "sess_*":
+        sess_id, fname, version, src, sport, dst, dport, start, end (epoch
+        seconds, end is 0 if no Alert seen), chsize, shsize, certsize,
+        cvsize, rttest, min_pdu, max_pdu, num_sizes, ntx, nrx
+    The packets table has one row per APDU in arrays named "pkt_*":
+        sess_id, dir (0 for c2s, 1 for s2c), size, delay (ms from start)
+    Packets are in session order, for each session c2s then s2c, each
+    in the order seen
+    '''
+    import numpy as np
+    nsess=len(sessions)
+    cols={}
+    for name in ['fname','version','src','sport','dst','dport']:
+        cols["sess_"+name]=np.array([getattr(s,name) for s in sessions],dtype=str)
+    cols["sess_id"]=np.fromiter((s.sess_id for s in sessions),dtype=np.uint32,count=nsess)
+    cols["sess_start"]=np.fromiter((s.timestamp for s in sessions),dtype=np.float64,count=nsess)
+    cols["sess_end"]=np.fromiter((s.end_time.timestamp() if isinstance(s.end_time,datetime.datetime) else 0.0 for s in sessions),dtype=np.float64,count=nsess)
+    for name in ['chsize','shsize','certsize','cvsize','rttest','max_pdu','num_sizes']:
+        cols["sess_"+name]=np.fromiter((getattr(s,name) for s in sessions),dtype=np.int64,count=nsess)
+    # min_pdu is sys.maxsize if we saw no APDUs, report that as 0
+    cols["sess_min_pdu"]=np.fromiter((s.min_pdu if s.min_pdu!=sys.maxsize else 0 for s in sessions),dtype=np.int64,count=nsess)
+    ntx=np.fromiter((len(s.s_psizes) for s in sessions),dtype=np.int64,count=nsess)
+    nrx=np.fromiter((len(s.d_psizes) for s in sessions),dtype=np.int64,count=nsess)
+    cols["sess_ntx"]=ntx
+    cols["sess_nrx"]=nrx
+    # the per-packet arrays are already typed so these are bulk copies
+    psizes=array(PSIZE_TYPE)
+    delays=array(DELAY_TYPE)
+    for s in sessions:
+        psizes+=s.s_psizes
+        psizes+=s.d_psizes
+        delays+=s.s_delays
+        delays+=s.d_delays
+    cols["pkt_sess_id"]=np.repeat(cols["sess_id"],ntx+nrx)
+    dirs=np.empty(2*nsess,dtype=np.int64)
+    dirs[0::2]=ntx
+    dirs[1::2]=nrx
+    cols["pkt_dir"]=np.repeat(np.tile(np.array([0,1],dtype=np.uint8),nsess),dirs)
+    cols["pkt_size"]=np.asarray(psizes,dtype=np.dtype(PSIZE_TYPE))
+    cols["pkt_delay"]=np.asarray(delays,dtype=np.dtype(DELAY_TYPE))
+    np.savez(outname,**cols)
@@ -4,7 +4,54 @@
 import math
 import wave, struct
 import sys
+import bisect
+import collections
 import soundfile 
+import numpy as np
+
+# The functions here work on audio as a list of float samples, as they
+# always have, but it's much quicker to start with a numpy array from
+# new_audio() and inject into that. Samples are made with numpy a note
+# at a time either way.
+
+def new_audio(
+        sample_rate=44100,
+        duration_milliseconds=500):
+    """
+    Make a (silent) numpy array of samples to inject into, same length
+    as append_silence would give
+    """
+    num_samples = duration_milliseconds * (sample_rate / 1000.0)
+    return np.zeros(int(num_samples),dtype=np.float64)
+
+def mix_in(audio,offset,nv):
+    """
+    Mix the samples in nv into audio starting at offset, where audio is
+    silent we just use the new value, otherwise we average the old and
+    new. Anything past the end of audio is dropped (as is anything before
+    the start)
+    """
+    if offset < 0:
+        nv=nv[-offset:]
+        offset=0
+    n=min(len(nv),len(audio)-offset)
+    if n <= 0:
+        return
+    if n < len(nv):
+        nv=nv[:n]
+    if isinstance(audio,np.ndarray):
+        ov=audio[offset:offset+n]
+        audio[offset:offset+n]=np.where(np.abs(ov)<=sys.float_info.epsilon,nv,0.5*ov+0.5*nv)
+    else:
+        ov=np.array(audio[offset:offset+n],dtype=np.float64)
+        audio[offset:offset+n]=np.where(np.abs(ov)<=sys.float_info.epsilon,nv,0.5*ov+0.5*nv).tolist()
+    return
+
+def inject_count(audio,offset,num_samples):
+    """
+    How many of num_samples starting at offset will land in audio
+    """
+    return max(0,min(int(num_samples),len(audio)-offset))
 
 def append_silence(
         audio=[],
@@ -15,8 +62,7 @@ def append_silence(
     """
     num_samples = duration_milliseconds * (sample_rate / 1000.0)
 
-    for x in range(int(num_samples)): 
-        audio.append(0.0)
+    audio.extend([0.0]*int(num_samples))
 
     return
 
@@ -66,8 +112,8 @@ def append_sinewave(
 
     num_samples = duration_milliseconds * (sample_rate / 1000.0)
 
-    for x in range(int(num_samples)):
-        audio.append(volume * math.sin(2 * math.pi * freq * ( x / sample_rate )))
+    xs=np.arange(int(num_samples))
+    audio.extend((volume * np.sin(2 * math.pi * freq * ( xs / sample_rate ))).tolist())
 
     return
 
@@ -87,25 +133,18 @@ def inject_sinewave(
     """ 
     num_samples = duration_milliseconds * (sample_rate / 1000.0)
     offset = int(start_time * (sample_rate /1000.0) )
-    al=len(audio)
-    for x in range(int(num_samples)):
-        try:
-            ind=x+offset
-            if ind<al:
-                ov=audio[x+offset]
-                nv=volume * math.sin(2 * math.pi * freq * ( x / sample_rate ))
-                if abs(ov) <= sys.float_info.epsilon:
-                    audio[x+offset]= nv
-                else:
-                    audio[x+offset]= 0.5 * ov + 0.5 * nv
-            else:
-                # we've filled to end, may as well return
-                return
-        except Exception as e:
-            print("Overflow: " + str(e) + " x: "  + str(x) + " offset: " + str(offset) + " len(audio): " + str(len(audio)))
-            #raise e
+    # only make the samples that'll fit
+    xs=np.arange(inject_count(audio,offset,num_samples))
+    mix_in(audio,offset,sinewave_samples(xs,offset,sample_rate,freq,volume))
     return
 
+def sinewave_samples(xs,offset,sample_rate,freq,volume):
+    """
+    Samples xs (counting from the start of the note at offset) of the
+    inject_sinewave sine wave
+    """
+    return volume * np.sin(2 * math.pi * freq * ( xs / sample_rate ))
+
 def damp(vol,n,x):
     '''
     Down the volume for nicer sounds
@@ -134,27 +173,21 @@ def inject_sinewave_damp(
         print("No samples!")
         return
     offset = int(start_time * (sample_rate /1000.0) )
-    al=len(audio)
-    for x in range(int(num_samples)):
-        try:
-            ind=x+offset
-            if ind<al:
-                ov=audio[x+offset]
-                #nv=damp(volume,num_samples,x) * math.sin(2 * math.pi * freq * ( ind / sample_rate ))
-                sin_in= (2 * math.pi * freq * ind) / sample_rate 
-                nv=volume * math.exp((-1.0*x)/sample_rate) * math.sin(4 * sin_in)
-                if abs(ov) <= sys.float_info.epsilon:
-                    audio[x+offset]= nv
-                else:
-                    audio[x+offset]= 0.5 * ov + 0.5 * nv
-            else:
-                # we've filled to end, may as well return
-                return
-        except Exception as e:
-            print("Overflow: " + str(e) + " x: "  + str(x) + " offset: " + str(offset) + " len(audio): " + str(len(audio)))
-            #raise e
+    xs=np.arange(inject_count(audio,offset,num_samples))
+    mix_in(audio,offset,damped_sinewave_samples(xs,offset,sample_rate,freq,volume))
     return
 
+def damped_sinewave_samples(xs,offset,sample_rate,freq,volume):
+    """
+    Samples xs (counting from the start of the note at offset) of the
+    inject_sinewave_damp wave, note the phase follows the overall sample
+    index not the note's
+    """
+    ind=xs+offset
+    #nv=damp(volume,num_samples,xs) * np.sin(2 * math.pi * freq * ( ind / sample_rate ))
+    sin_in= (2 * math.pi * freq * ind) / sample_rate 
+    return volume * np.exp((-1.0*xs)/sample_rate) * np.sin(4 * sin_in)
+
 def inject_filtered_sinewave(
         audio=[],
         sample_rate=44100,
@@ -206,50 +239,58 @@ def filter_existing(
         volume=1.0,
         thefilter=None,
         filarr=None):
+    """
+    Apply thefilter to what's already in audio from start_time, the filter
+    is called with a numpy array of times (in ms) and filarr and gives
+    back the array of filter values for those, we do a block at a time
+    (see filter_block)
+    """
     if thefilter is None:
         return
-    num_samples = duration_milliseconds * (sample_rate / 1000.0)
+    num_samples = int(duration_milliseconds * (sample_rate / 1000.0))
     offset = int(start_time * (sample_rate /1000.0) )
-    al=len(audio)
-    for x in range(int(num_samples)):
-        try:
-            ind=x+offset
-            msval=int(1000*ind/sample_rate)
-            if ind<al:
-                ov=audio[ind]
-                if abs(ov) <= sys.float_info.epsilon:
-                    print("ov too small, ov: " + str(ov) + " at index: " + str(ind) + " msval=" + str(msval))
-                fval=thefilter(msval,filarr)
-                # alternatives below...
-                # alt1: divide - too loud
-                #if abs(fval)>sys.float_info.epsilon:
-                    #nv=ov/fval
-                #else:
-                    #nv=ov
-                # alt2: multiply - too quiet
-                # nv=ov*fval
-                # alt3: add - just "as is" with noise
-                #nv=ov+fval
-                # alt4: sine of sum
-                #nv=math.sin(ov+fval)
-                # alt5: average
-                if abs(ov) > sys.float_info.epsilon:
-                    nv=0.5*fval+0.5*ov
-                else:
-                    nv=fval
-                if abs(nv) > sys.float_info.epsilon:
-                    audio[ind]=nv
-                    #if (msval%100)==0:
-                        #print("Replaced " + str(ov) + " with " + str(nv) + " at index: " + str(ind) + " msval=" + str(msval))
-                        #print("Diff: " + str(ov-nv) + " ratio: " + str(ov/nv))
-                else:
-                    print("nv too small, ov: " + str(ov) + " nv:" + str(nv) + " at index: " + str(ind) + " msval=" + str(msval))
-            else:
-                # we've filled to end, may as well return
-                return
-        except Exception as e:
-            print("Overflow: " + str(e) + " x: "  + str(x) + " offset: " + str(offset) + " len(audio): " + str(len(audio)))
-            #raise e
+    # we've filled to end, no need to go further
+    end=min(offset+num_samples,len(audio))
+    for bstart in range(max(offset,0),end,WAV_CHUNK):
+        bend=min(bstart+WAV_CHUNK,end)
+        if isinstance(audio,np.ndarray):
+            filter_block(audio[bstart:bend],bstart,sample_rate,thefilter,filarr)
+        else:
+            block=np.array(audio[bstart:bend],dtype=np.float64)
+            filter_block(block,bstart,sample_rate,thefilter,filarr)
+            audio[bstart:bend]=block.tolist()
+    return
+
+def filter_block(block,bstart,sample_rate,thefilter,filarr):
+    """
+    Filter a block of samples (in place) that starts at sample bstart, each
+    sample is averaged with the filter value for its time (in ms), or if
+    the sample is silent replaced by it
+    We leave a sample alone if the result would be silent
+    """
+    ov=block
+    ind=np.arange(bstart,bstart+len(block))
+    msval=(1000*ind/sample_rate).astype(np.int64)
+    eps=sys.float_info.epsilon
+    quiet=np.abs(ov) <= eps
+    if quiet.any():
+        print("ov too small at " + str(int(quiet.sum())) + " of " + str(len(block)) + " samples from index: " + str(bstart) + " msval=" + str(msval[0]))
+    fval=np.asarray(thefilter(msval,filarr),dtype=np.float64)
+    # alternatives below...
+    # alt1: divide - too loud
+    # nv=np.where(np.abs(fval)>eps,ov/fval,ov)
+    # alt2: multiply - too quiet
+    # nv=ov*fval
+    # alt3: add - just "as is" with noise
+    #nv=ov+fval
+    # alt4: sine of sum
+    #nv=np.sin(ov+fval)
+    # alt5: average
+    nv=np.where(quiet,fval,0.5*fval+0.5*ov)
+    loud=np.abs(nv) > eps
+    if not loud.all():
+        print("nv too small at " + str(int((~loud).sum())) + " of " + str(len(block)) + " samples from index: " + str(bstart) + " msval=" + str(msval[0]))
+    block[loud]=nv[loud]
     return
 
 # This is a bit silly but might keep it anyway:-)
@@ -296,6 +337,19 @@ def inject_filtered_constant(
     return
 
 
+# how many samples save_wav converts and writes at a time
+WAV_CHUNK=1<<18
+
+def samples2frames(samples):
+    """
+    Turn float samples (list or numpy array) into 16 bit wav frames
+    Samples outside -1.0 to 1.0 wrap around, i.e. we keep the fractional
+    part with the sign, (that's fmod) then scale by 32767 and truncate
+    towards zero as int() does
+    """
+    a=np.asarray(samples,dtype=np.float64)
+    return (np.fmod(a,1.0) * 32767.0).astype(np.int16).tobytes()
+
 def save_wav(file_name,audio=[],sample_rate=44100):
     # Open up a wav file
     wav_file=wave.open(file_name,"w")
@@ -318,16 +372,225 @@ def save_wav(file_name,audio=[],sample_rate=44100):
     # maximum value for a short integer.  NOTE: It is theortically possible to
     # use the floating point -1.0 to 1.0 data directly in a WAV file but not
     # obvious how to do that using the wave module in python.
-    for sample in audio:
-        # normalise if needed
-        if sample > 0:
-            sample=sample%1
-        if sample < 0:
-            sample=-1*(abs(sample)%1)
-        wav_file.writeframes(struct.pack('h', int( sample * 32767.0 )))
+    # We do that a chunk of samples at a time, see samples2frames.
+    for start in range(0,nframes,WAV_CHUNK):
+        wav_file.writeframes(samples2frames(audio[start:start+WAV_CHUNK]))
+
+    wav_file.close()
+
+    return
+
+# the sample makers for what render_wav can do
+render_samples={
+        inject_sinewave: sinewave_samples,
+        inject_sinewave_damp: damped_sinewave_samples,
+        }
 
+def render_wav(
+        file_name,
+        notes=[],
+        sample_rate=44100,
+        duration_milliseconds=500,
+        block_samples=WAV_CHUNK):
+    """
+    Render notes straight into a wav file, giving the same result as injecting
+    each into new_audio(sample_rate,duration_milliseconds) in turn and then
+    calling save_wav, but only ever holding one block of samples
+    Each note is a tuple of (inject, freq, start_time, duration_milliseconds,
+    volume) where inject is inject_sinewave or inject_sinewave_damp, in the
+    order they'd have been injected (that matters as we average)
+    We sort notes by start, then for each block mix in those that overlap it
+    (in the original order), write it out and forget notes that are done
+    """
+    nframes=int(duration_milliseconds * (sample_rate / 1000.0))
+    pending=[]
+    for order,(inject,freq,start_time,dur,volume) in enumerate(notes):
+        num_samples=int(dur * (sample_rate / 1000.0))
+        offset=int(start_time * (sample_rate /1000.0) )
+        if num_samples <= 0 or offset+num_samples <= 0 or offset >= nframes:
+            continue
+        pending.append((order,offset,num_samples,render_samples[inject],freq,volume))
+    pending.sort(key=lambda n: n[1])
+
+    wav_file=wave.open(file_name,"w")
+    wav_file.setparams((1, 2, sample_rate, nframes, "NONE", "not compressed"))
+    active=[]
+    nextnote=0
+    for bstart in range(0,nframes,block_samples):
+        bend=min(bstart+block_samples,nframes)
+        block=np.zeros(bend-bstart,dtype=np.float64)
+        # notes starting before the end of this block are now active,
+        # we keep those in their original order
+        while nextnote < len(pending) and pending[nextnote][1] < bend:
+            bisect.insort(active,pending[nextnote])
+            nextnote+=1
+        stillactive=[]
+        for n in active:
+            order,offset,num_samples,samples,freq,volume=n
+            lo=max(offset,bstart)
+            hi=min(offset+num_samples,bend)
+            if lo < hi:
+                xs=np.arange(lo-offset,hi-offset)
+                mix_in(block,lo-bstart,samples(xs,offset,sample_rate,freq,volume))
+            if offset+num_samples > bend:
+                stillactive.append(n)
+        active=stillactive
+        wav_file.writeframes(samples2frames(block))
     wav_file.close()
+    return
+
+def filter_wav(
+        file_name,
+        in_fname="audio-in.wav",
+        filters=[],
+        sample_rate=44100,
+        duration_milliseconds=500,
+        block_samples=WAV_CHUNK):
+    """
+    Read (the 1st channel of) up to duration_milliseconds of in_fname,
+    apply filters to it as filter_existing would and write the result to
+    file_name, a block at a time so we never hold the lot
+    Each filter is a tuple of (start_time, duration_milliseconds, thefilter,
+    filarr) and they're applied in list order
+    The same as append_file, filter_existing for each and save_wav
+    """
+    num_samples=int(duration_milliseconds * (sample_rate / 1000.0))
+    franges=[]
+    for start_time,dur,thefilter,filarr in filters:
+        offset = int(start_time * (sample_rate /1000.0) )
+        franges.append((offset,offset+int(dur * (sample_rate / 1000.0)),thefilter,filarr))
+    try:
+        sf=soundfile.SoundFile(in_fname)
+    except Exception as e:
+        # as with append_file we end up with nothing to filter
+        print("filter_wav exception " + str(e) )
+        sf=None
+    nframes=0
+    if sf is not None:
+        if sf.samplerate != sample_rate:
+            print("Weird sample rate, got: " + str(sf.samplerate) + " wanted: " + str(sample_rate))
+        nframes=min(num_samples,sf.frames)
+    wav_file=wave.open(file_name,"w")
+    wav_file.setparams((1, 2, sample_rate, nframes, "NONE", "not compressed"))
+    for bstart in range(0,nframes,block_samples):
+        bend=min(bstart+block_samples,nframes)
+        block=sf.read(bend-bstart,dtype='float64',always_2d=True)[:,0].copy()
+        for fstart,fend,thefilter,filarr in franges:
+            lo=max(fstart,bstart)
+            hi=min(fend,bend)
+            if lo < hi:
+                filter_block(block[lo-bstart:hi-bstart],lo,sample_rate,thefilter,filarr)
+        wav_file.writeframes(samples2frames(block))
+    wav_file.close()
+    if sf is not None:
+        sf.close()
+    return
 
+def render_block(job):
+    """
+    Render one block of a mix of groups of notes (e.g. sessions), job is
+    (notes, sample_rate, bstart, bend) where notes are the ones that
+    overlap samples [bstart:bend) as (group, order, offset, num_samples,
+    samples, freq, volume), sorted by group and then order (see
+    mixdown_jobs)
+    Each group's notes are mixed as with inject_*, then each group is
+    mixed into the block in turn using mix_clip
+    This is a top-level function so it can be used in a process pool.
+    """
+    notes,sample_rate,bstart,bend=job
+    block=np.zeros(bend-bstart,dtype=np.float64)
+    clip=None
+    current_group=None
+    for group,order,offset,num_samples,samples,freq,volume in notes:
+        if group!=current_group:
+            if clip is not None:
+                mix_clip(block,0,clip)
+            clip=np.zeros(bend-bstart,dtype=np.float64)
+            current_group=group
+        lo=max(offset,bstart)
+        hi=min(offset+num_samples,bend)
+        xs=np.arange(lo-offset,hi-offset)
+        mix_in(clip,lo-bstart,samples(xs,offset,sample_rate,freq,volume))
+    if clip is not None:
+        mix_clip(block,0,clip)
+    return block
+
+def mix_clip(audio,offset,nv):
+    """
+    Mix a group's samples into audio: where the group is silent we leave
+    audio alone, where audio is silent we take the group's, otherwise
+    we average the two (the same pairwise rule as mix_in)
+    """
+    n=min(len(nv),len(audio)-offset)
+    if n <= 0:
+        return
+    nv=nv[:n]
+    ov=audio[offset:offset+n]
+    eps=sys.float_info.epsilon
+    audio[offset:offset+n]=np.where(np.abs(nv)<=eps,ov,
+            np.where(np.abs(ov)<=eps,nv,0.5*ov+0.5*nv))
+    return
+
+def mixdown_jobs(groups,sample_rate,nframes,block_samples):
+    """
+    Yield a render_block job for each block in turn, as for render_wav
+    we sort all the notes by start and for each block only carry the
+    ones that overlap it, kept in group and then original order
+    """
+    pending=[]
+    for group,notes in enumerate(groups):
+        for order,(inject,freq,start_time,dur,volume) in enumerate(notes):
+            num_samples=int(dur * (sample_rate / 1000.0))
+            offset=int(start_time * (sample_rate /1000.0) )
+            if num_samples <= 0 or offset+num_samples <= 0 or offset >= nframes:
+                continue
+            pending.append((group,order,offset,num_samples,render_samples[inject],freq,volume))
+    pending.sort(key=lambda n: n[2])
+    active=[]
+    nextnote=0
+    for bstart in range(0,nframes,block_samples):
+        bend=min(bstart+block_samples,nframes)
+        while nextnote < len(pending) and pending[nextnote][2] < bend:
+            bisect.insort(active,pending[nextnote])
+            nextnote+=1
+        yield active,sample_rate,bstart,bend
+        active=[n for n in active if n[2]+n[3] > bend]
+
+def mixdown_wav(
+        file_name,
+        groups=[],
+        pool=None,
+        sample_rate=44100,
+        duration_milliseconds=500,
+        block_samples=WAV_CHUNK,
+        inflight=4):
+    """
+    Render groups of notes (e.g. one list per session, notes as for
+    render_wav) into a wav, each group is mixed on its own and then
+    the groups are mixed in list order using mix_clip
+    That's the same as rendering all the notes in one go if groups don't
+    overlap in time, where they do each group's notes are averaged with
+    the mix of earlier groups as a whole rather than note by note
+    Blocks are rendered in pool (if given) with at most inflight of them
+    on the go at once and written out in order as they come back, so
+    we only ever hold a few blocks of samples
+    """
+    nframes=int(duration_milliseconds * (sample_rate / 1000.0))
+    wav_file=wave.open(file_name,"w")
+    wav_file.setparams((1, 2, sample_rate, nframes, "NONE", "not compressed"))
+    jobs=mixdown_jobs(groups,sample_rate,nframes,block_samples)
+    if pool is None:
+        for job in jobs:
+            wav_file.writeframes(samples2frames(render_block(job)))
+    else:
+        running=collections.deque()
+        for job in jobs:
+            running.append(pool.apply_async(render_block,(job,)))
+            if len(running) >= inflight:
+                wav_file.writeframes(samples2frames(running.popleft().get()))
+        while running:
+            wav_file.writeframes(samples2frames(running.popleft().get()))
+    wav_file.close()
     return
 
 
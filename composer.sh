@@ -46,12 +46,12 @@ function usage()
     echo "-s - suppress silence or noise that doesn't change for the specified limit (in ms)"
     echo "-c - clean out audio files in this directory (*.midi.csv, *.wav, *.midi)"
     echo "-n - do not clean up temporary files when getting URLs"
-    echo "-k - skip new data generation and just map csv's to midi's in the current dir"
+    echo "-k - skip new data generation and just map the .midi files in the current dir to .ogg and .png"
     echo "-L - use logarithmic time"
     echo "-S - use scaled time"
     echo "-v - be verbose"
     echo "-I - generate ignore list (DNS stubby DoT sessions and selenium's defaults)"
-    echo "-w - produce .wav files as well as .midi (warning: slow, maybe buggy)"
+    echo "-w - produce .wav files as well as .midi (warning: maybe buggy)"
     echo "-1 - use Tls2Music.py"
     echo "-2 - use Tls2Music2.py"
     echo "-3 - use Tls3Music3.py"
@@ -296,7 +296,7 @@ then
 
             if [[ "$getpage_failed" == "no" ]]
             then
-                # Do the analysis to generate the csvmidi files (and optonal .wavs)
+                # Do the analysis to generate the .midi files (and optonal .wavs)
 
                 case "$T2MVER" in
                     1)
@@ -421,7 +421,7 @@ then
     fi
 fi
 
-# One-shot analysis to generate the csvmidi files (and optonal .wavs)
+# One-shot analysis to generate the .midi files (and optonal .wavs)
 if [[ "$SKIP" == "no" && "$URL" == "" ]]
 then
     if [[ "$GENIGNORE" == "yes" ]]
@@ -431,18 +431,16 @@ then
     $SRCDIR/Tls2Music.py -f $OFILE $LABEL $VERBOSE $WAVOUT $LOGTIME $SUPPRESS $INSTRUMENT $SCALED $VANTAGE $NOTEGEN $MAXNOTE
 fi
 
-# Now map the csvs to midis (if there are any - that's the first
-# if statement) and ogg and png 
-csvs=(*.midi.csv)
-if [ -e  "${csvs[0]}" ];
+# Now map the midis to ogg and png (if there are any - that's the first
+# if statement), Tls2Music writes the .midi files itself these days
+midis=(*.midi)
+if [ -e  "${midis[0]}" ];
 then
-    for file in *.midi.csv
+    for mf in *.midi
     do
-        mf=`basename $file .csv`
         df=`basename $mf .midi`
-        if [ $file -nt $mf ]
+        if [ $mf -nt $df.ogg ]
         then
-            csvmidi $file $mf
             if [[ "$VERBOSE" != "" ]]
             then
                 timidity $mf -Ov -o $df.ogg
@@ -454,13 +452,13 @@ then
             # then truncate back to 30s for graphic
             sox $df.ogg silence.ogg -n spectrogram -o $df.png -d 30.0 -x 1000 trim 0.0 30.0 
         else
-            echo "Skipping $file as $mf is newer"
+            echo "Skipping $mf as $df.ogg is newer"
         fi
     done
 else
     if [[ "$T2MVER" != "3" ]]
     then
-        echo "$0: No csvs to process - exiting"
+        echo "$0: No midis to process - exiting"
         exit 4
     fi
 fi
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019 Stephen Farrell, stephen.farrell@cs.tcd.ie
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# A minimal Standard MIDI File (format 1) writer, so we can go straight
+# from our in-memory midicsv event lists to a .midi file without writing
+# out the text and running csvmidi on it. We only do what the Tls2Music
+# scripts produce: a header track with a few meta events and then one
+# track per channel with a name, a program change and note on/offs. See
+# https://www.midi.org/specifications for the file format.
+
+import struct
+
+# status bytes
+NOTE_OFF=0x80
+NOTE_ON=0x90
+PROGRAM_CHANGE=0xC0
+META=0xFF
+
+# meta event types
+META_TEXT=0x01
+META_COPYRIGHT=0x02
+META_TITLE=0x03
+META_INSTRUMENT_NAME=0x04
+META_END_TRACK=0x2F
+META_TEMPO=0x51
+META_TIME_SIGNATURE=0x58
+
+# the record type names csvmidi uses, our midicsv lines have those in
+# col 2, possibly with commas around them
+CSV_CMDS={
+        'note_on_c': NOTE_ON,
+        'note_off_c': NOTE_OFF,
+        }
+
+def varlen(val):
+    '''
+    encode val as a MIDI variable length quantity, 7 bits per byte, most
+    significant first with the top bit set on all but the last byte
+    '''
+    if val < 0 or val > 0x0FFFFFFF:
+        raise ValueError('Bad MIDI variable length value: ' + str(val))
+    out=bytearray([val & 0x7F])
+    val >>= 7
+    while val:
+        out.insert(0,0x80 | (val & 0x7F))
+        val >>= 7
+    return bytes(out)
+
+def _data(val,what):
+    # MIDI data bytes are 7 bits, csvmidi would also refuse these
+    val=int(val)
+    if val < 0 or val > 127:
+        raise ValueError('Bad MIDI ' + what + ': ' + str(val))
+    return val
+
+class MidiTrack():
+    '''
+    One MTrk chunk, events are added with absolute times (ticks) that
+    must not go backwards, we store delta times as we go
+    '''
+    __slots__ = [
+            'data',
+            'last_time',
+            ]
+
+    def __init__(self):
+        self.data=bytearray()
+        self.last_time=0
+
+    def event(self,time,ev):
+        time=int(time)
+        if time < self.last_time:
+            raise ValueError('MIDI event time went backwards: ' + str(time) + ' < ' + str(self.last_time))
+        self.data += varlen(time-self.last_time)
+        self.data += ev
+        self.last_time=time
+
+    def meta(self,time,mtype,payload):
+        self.event(time,bytes([META,mtype])+varlen(len(payload))+payload)
+
+    def text(self,time,mtype,txt):
+        self.meta(time,mtype,txt.encode('latin-1','replace'))
+
+    def tempo(self,time,usecs):
+        self.meta(time,META_TEMPO,struct.pack('>I',usecs)[1:])
+
+    def time_signature(self,time,num,denom,clocks,notes32):
+        self.meta(time,META_TIME_SIGNATURE,bytes([num,denom,clocks,notes32]))
+
+    def program(self,time,channel,prog):
+        self.event(time,bytes([PROGRAM_CHANGE | (_data(channel,'channel') & 0x0F),_data(prog,'program')]))
+
+    def note(self,time,status,channel,notenum,vel):
+        # velocities can come out of velocity() a bit off the ends, those
+        # just mean quietest/loudest
+        vel=min(max(int(vel),0),127)
+        self.event(time,bytes([status | (_data(channel,'channel') & 0x0F),_data(notenum,'note'),vel]))
+
+    def end(self,time):
+        self.meta(max(int(time),self.last_time),META_END_TRACK,b'')
+
+    def chunk(self):
+        return b'MTrk' + struct.pack('>I',len(self.data)) + bytes(self.data)
+
+def write_midi(fname,midicsv,title,program,division=480,tempo=500000):
+    '''
+    Write a format 1 SMF to fname from midicsv, a list of lines like:
+        [track,time,note_on/off-string,channel,notenum,velocity,instrument]
+    sorted by track and then time, i.e. what the Tls2Music scripts would
+    write out as text for csvmidi. program(channel,instrument) gives the
+    program number for each track (from the first line for that track),
+    much as the .midi.csv would have it we start with a track of meta
+    events with title in it
+    '''
+    tracks=[]
+    head=MidiTrack()
+    head.text(0,META_TITLE,title)
+    head.text(0,META_TEXT,"see https://github.com/sftcd/tlspad/")
+    head.text(0,META_COPYRIGHT,"This file is in the public domain")
+    head.time_signature(0,4,2,24,8)
+    head.tempo(0,tempo)
+    head.end(0)
+    tracks.append(head)
+    current_track=None
+    trk=None
+    for line in midicsv:
+        if line[0]!=current_track:
+            if trk is not None:
+                trk.end(trk.last_time)
+            current_track=line[0]
+            trk=MidiTrack()
+            tracks.append(trk)
+            trk.text(0,META_INSTRUMENT_NAME,"channel "+str(line[3]))
+            trk.program(0,line[3],program(line[3],line[6]))
+        status=CSV_CMDS.get(line[2].strip(', ').lower())
+        if status is None:
+            raise ValueError('Unknown MIDI event: ' + str(line[2]))
+        trk.note(line[1],status,line[3],line[4],line[5])
+    if trk is not None:
+        trk.end(trk.last_time)
+    with open(fname,"wb") as f:
+        f.write(b'MThd' + struct.pack('>IHHH',6,1,len(tracks),division))
+        for t in tracks:
+            f.write(t.chunk())
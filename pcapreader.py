@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019 Stephen Farrell, stephen.farrell@cs.tcd.ie
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# A minimal pcap/pcapng reader that gets us from frames to TLS records
+# without going via tshark. We only care about TCP over IPv4/IPv6 (over
+# ethernet, linux cooked captures, loopback or raw IP) and only about
+# TLS record headers (plus handshake types and the odd certificate)
+# so that's all that's handled here. The TLSSession bits are done in
+# TlsPadFncs.analyse_pcap_native
+
+import struct,socket
+
+# link layer types we know how to handle, see:
+# https://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL=0
+LINKTYPE_ETHERNET=1
+LINKTYPE_RAW=101
+LINKTYPE_LOOP=108
+LINKTYPE_LINUX_SLL=113
+LINKTYPE_IPV4=228
+LINKTYPE_IPV6=229
+LINKTYPE_LINUX_SLL2=276
+
+# ethertypes
+ETH_IPV4=0x0800
+ETH_IPV6=0x86dd
+ETH_VLAN=(0x8100,0x88a8,0x9100)
+
+# pcapng block types
+PCAPNG_SHB=0x0A0D0D0A
+PCAPNG_IDB=1
+PCAPNG_OPB=2
+PCAPNG_EPB=6
+
+# TCP flags
+TCP_FIN=0x01
+TCP_SYN=0x02
+TCP_RST=0x04
+
+# TLS content types, see the IANA registry
+TLS_CCS=20
+TLS_ALERT=21
+TLS_HANDSHAKE=22
+TLS_APPDATA=23
+TLS_HEARTBEAT=24
+
+# biggest record we'll believe (2^14 plus max expansion)
+TLS_MAX_RECLEN=18432
+
+# if a half-connection has more than this many out-of-order segments
+# queued up we'll give up waiting for the gap to fill and move on
+MAX_PENDING_SEGS=64
+
+def _read_pcap(f,hdr):
+    '''
+    generator for classic pcap files, hdr is the first 4 octets
+    '''
+    if hdr==b'\xd4\xc3\xb2\xa1':
+        endian='<'
+        nsecs=False
+    elif hdr==b'\xa1\xb2\xc3\xd4':
+        endian='>'
+        nsecs=False
+    elif hdr==b'\x4d\x3c\xb2\xa1':
+        endian='<'
+        nsecs=True
+    elif hdr==b'\xa1\xb2\x3c\x4d':
+        endian='>'
+        nsecs=True
+    else:
+        raise ValueError('Not a pcap file')
+    rest=f.read(20)
+    if len(rest)<20:
+        raise ValueError('Truncated pcap file header')
+    linktype=struct.unpack(endian+'HHiIII',rest)[5] & 0x0fffffff
+    rechdr=struct.Struct(endian+'IIII')
+    while True:
+        rh=f.read(16)
+        if len(rh)<16:
+            return
+        secs,frac,caplen,origlen=rechdr.unpack(rh)
+        data=f.read(caplen)
+        if len(data)<caplen:
+            # truncated file, happens if capture was killed
+            return
+        if not nsecs:
+            frac=frac*1000
+        yield linktype,secs,frac,data
+
+def _read_pcapng(f):
+    '''
+    generator for pcapng files, we've consumed the 1st 4 octets
+    of the section header block already
+    '''
+    endian='<'
+    # per interface (linktype,ticks-per-second)
+    ifaces=[]
+    first=True
+    while True:
+        if first:
+            btype=PCAPNG_SHB
+            blen_raw=f.read(4)
+            if len(blen_raw)<4:
+                return
+        else:
+            bh=f.read(8)
+            if len(bh)<8:
+                return
+            btype=struct.unpack(endian+'I',bh[0:4])[0]
+            blen_raw=bh[4:8]
+        first=False
+        if btype==PCAPNG_SHB:
+            # figure endianness from byte order magic
+            bom=f.read(4)
+            if bom==b'\x4d\x3c\x2b\x1a':
+                endian='<'
+            elif bom==b'\x1a\x2b\x3c\x4d':
+                endian='>'
+            else:
+                raise ValueError('Bad pcapng byte order magic')
+            blen=struct.unpack(endian+'I',blen_raw)[0]
+            body=f.read(blen-12)
+            if len(body)<blen-12:
+                return
+            # new section, interface numbering starts over
+            ifaces=[]
+            continue
+        blen=struct.unpack(endian+'I',blen_raw)[0]
+        if blen<12:
+            raise ValueError('Bad pcapng block length: ' + str(blen))
+        body=f.read(blen-8)
+        if len(body)<blen-8:
+            return
+        # body includes the trailing copy of the block length
+        body=body[:-4]
+        if btype==PCAPNG_IDB:
+            linktype=struct.unpack(endian+'H',body[0:2])[0]
+            tps=1000000
+            # walk options for if_tsresol (code 9)
+            pos=8
+            while pos+4<=len(body):
+                ocode,olen=struct.unpack(endian+'HH',body[pos:pos+4])
+                if ocode==0:
+                    break
+                if ocode==9 and olen>=1:
+                    res=body[pos+4]
+                    if res & 0x80:
+                        tps=2**(res & 0x7f)
+                    else:
+                        tps=10**res
+                pos+=4+((olen+3)&~3)
+            ifaces.append((linktype,tps))
+        elif btype==PCAPNG_EPB or btype==PCAPNG_OPB:
+            if btype==PCAPNG_EPB:
+                ifid,tshigh,tslow,caplen=struct.unpack(endian+'IIII',body[0:16])
+            else:
+                ifid,drops,tshigh,tslow,caplen=struct.unpack(endian+'HHIII',body[0:16])
+            if ifid>=len(ifaces):
+                raise ValueError('pcapng packet for unknown interface ' + str(ifid))
+            linktype,tps=ifaces[ifid]
+            ticks=(tshigh<<32)|tslow
+            secs=ticks//tps
+            frac=((ticks%tps)*1000000000)//tps
+            yield linktype,secs,frac,body[20:20+caplen]
+        # anything else (simple packets, stats, name resolution...) we skip
+
+def read_frames(fname):
+    '''
+    generator that yields (linktype,secs,nsecs,data) for each frame
+    in a pcap or pcapng file
+    '''
+    with open(fname,"rb") as f:
+        hdr=f.read(4)
+        if len(hdr)<4:
+            return
+        if struct.unpack('<I',hdr)[0]==PCAPNG_SHB:
+            yield from _read_pcapng(f)
+        else:
+            yield from _read_pcap(f,hdr)
+
+def decode_tcp(linktype,data):
+    '''
+    Dig down to the TCP segment in a frame, returning
+    (src,dst,sport,dport,seq,flags,payload,plen) or None if
+    it's not TCP over IPv4/IPv6. Addresses and ports are
+    strings, as they are in the pyshark code. plen is the
+    payload length according to the headers, which can be
+    more than len(payload) if the capture was snapped.
+    '''
+    etype=0
+    pos=0
+    if linktype==LINKTYPE_ETHERNET:
+        if len(data)<14:
+            return None
+        etype=(data[12]<<8)|data[13]
+        pos=14
+        while etype in ETH_VLAN and len(data)>=pos+4:
+            etype=(data[pos+2]<<8)|data[pos+3]
+            pos+=4
+    elif linktype==LINKTYPE_LINUX_SLL:
+        if len(data)<16:
+            return None
+        etype=(data[14]<<8)|data[15]
+        pos=16
+    elif linktype==LINKTYPE_LINUX_SLL2:
+        if len(data)<20:
+            return None
+        etype=(data[0]<<8)|data[1]
+        pos=20
+    elif linktype==LINKTYPE_NULL or linktype==LINKTYPE_LOOP:
+        if len(data)<4:
+            return None
+        # address family is in the capturing host's byte order for
+        # NULL (so guess), and network byte order for LOOP
+        fam=struct.unpack('>I',data[0:4])[0]
+        if linktype==LINKTYPE_NULL and fam>0xffff:
+            fam=struct.unpack('<I',data[0:4])[0]
+        if fam==2:
+            etype=ETH_IPV4
+        elif fam in (10,24,28,30):
+            etype=ETH_IPV6
+        pos=4
+    elif linktype==LINKTYPE_RAW or linktype==LINKTYPE_IPV4 or linktype==LINKTYPE_IPV6:
+        if len(data)<1:
+            return None
+        ver=data[0]>>4
+        if ver==4:
+            etype=ETH_IPV4
+        elif ver==6:
+            etype=ETH_IPV6
+    else:
+        return None
+
+    if etype==ETH_IPV4:
+        if len(data)<pos+20:
+            return None
+        ihl=(data[pos]&0x0f)*4
+        totlen=(data[pos+2]<<8)|data[pos+3]
+        fragbits=((data[pos+6]<<8)|data[pos+7]) & 0x3fff
+        if data[pos+9]!=6 or fragbits!=0:
+            # not TCP, or a fragment, either way not for us
+            return None
+        src=socket.inet_ntoa(data[pos+12:pos+16])
+        dst=socket.inet_ntoa(data[pos+16:pos+20])
+        tpos=pos+ihl
+        tend=pos+totlen
+    elif etype==ETH_IPV6:
+        if len(data)<pos+40:
+            return None
+        nh=data[pos+6]
+        paylen=(data[pos+4]<<8)|data[pos+5]
+        src=socket.inet_ntop(socket.AF_INET6,data[pos+8:pos+24])
+        dst=socket.inet_ntop(socket.AF_INET6,data[pos+24:pos+40])
+        tpos=pos+40
+        tend=tpos+paylen
+        # skip extension headers: hop-by-hop, routing, dest opts
+        while nh in (0,43,60) and len(data)>=tpos+2:
+            nh=data[tpos]
+            tpos+=(data[tpos+1]+1)*8
+        if nh!=6:
+            # fragments (44) and non-TCP ignored
+            return None
+    else:
+        return None
+
+    if len(data)<tpos+20:
+        return None
+    sport=(data[tpos]<<8)|data[tpos+1]
+    dport=(data[tpos+2]<<8)|data[tpos+3]
+    seq=struct.unpack('>I',data[tpos+4:tpos+8])[0]
+    doff=(data[tpos+12]>>4)*4
+    flags=data[tpos+13]
+    ppos=tpos+doff
+    plen=tend-ppos
+    if plen<0:
+        return None
+    payload=data[ppos:min(tend,len(data))]
+    return src,dst,str(sport),str(dport),seq,flags,payload,plen
+
+class TLSHalfStream():
+    '''
+    Reassemble one direction of a TCP connection into TLS records.
+    We don't keep the bodies of application data records, only of
+    the records we might want to look inside (handshakes mainly).
+    '''
+    __slots__ = [
+            'nextseq', # next TCP sequence number we expect
+            'pending', # out-of-order segments, keyed by seq
+            'buf', # octets of a not-yet-complete record
+            'skip', # octets of the current appdata record still to come
+            'skiphdr', # header of the record we're skipping through
+            'synced', # whether we think we're at a record boundary
+            'ccs_seen', # after a CCS handshake bodies are encrypted
+            ]
+
+    def __init__(self):
+        self.nextseq=None
+        self.pending={}
+        self.buf=bytearray()
+        self.skip=0
+        self.skiphdr=None
+        self.synced=False
+        self.ccs_seen=False
+
+    def desync(self):
+        self.buf=bytearray()
+        self.skip=0
+        self.skiphdr=None
+        self.synced=False
+
+    def add(self,seq,flags,payload,plen):
+        '''
+        Add a TCP segment and return the list of TLS records completed
+        by that, each as (content_type,version,length,body) where body
+        is None unless it's a cleartext handshake (or alert/CCS)
+        '''
+        recs=[]
+        if flags & TCP_SYN:
+            self.nextseq=(seq+1) & 0xffffffff
+            self.pending={}
+            self.desync()
+            # a new connection on the same 4-tuple starts in the clear
+            self.ccs_seen=False
+            return recs
+        if plen==0:
+            return recs
+        if self.nextseq is None:
+            # joined mid-stream
+            self.nextseq=seq
+        diff=(seq-self.nextseq) & 0xffffffff
+        if diff>=0x80000000:
+            # (partly) a retransmission of stuff we've seen
+            overlap=(self.nextseq-seq) & 0xffffffff
+            if overlap>=plen:
+                return recs
+            payload=payload[overlap:]
+            plen-=overlap
+            seq=self.nextseq
+        elif diff>0:
+            # a gap, hold on to this 'till it's filled
+            if seq not in self.pending:
+                self.pending[seq]=(payload,plen)
+            if len(self.pending)>MAX_PENDING_SEGS:
+                # give up on the gap
+                self.desync()
+                self.nextseq=min(self.pending,key=lambda x: (x-self.nextseq) & 0xffffffff)
+                self._drain(recs)
+            return recs
+        self._consume(payload,plen,recs)
+        self._drain(recs)
+        return recs
+
+    def _drain(self,recs):
+        while self.nextseq in self.pending:
+            payload,plen=self.pending.pop(self.nextseq)
+            self._consume(payload,plen,recs)
+
+    def _consume(self,payload,plen,recs):
+        self.nextseq=(self.nextseq+plen) & 0xffffffff
+        if len(payload)<plen:
+            # snapped capture, we can't know what we missed
+            self.desync()
+            return
+        pos=0
+        if not self.synced:
+            # only (re)start at a segment that looks like a record start
+            if not self._goodhdr(payload,0):
+                return
+            self.synced=True
+        if self.skip>0:
+            if self.skip>plen:
+                self.skip-=plen
+                return
+            pos=self.skip
+            self.skip=0
+            recs.append(self.skiphdr)
+            self.skiphdr=None
+        if len(self.buf)>0:
+            data=self.buf+payload[pos:]
+            self.buf=bytearray()
+        else:
+            data=payload[pos:]
+        dlen=len(data)
+        pos=0
+        while dlen-pos>=5:
+            if not self._goodhdr(data,pos):
+                self.desync()
+                return
+            ctype=data[pos]
+            ver=(data[pos+1]<<8)|data[pos+2]
+            rlen=(data[pos+3]<<8)|data[pos+4]
+            end=pos+5+rlen
+            if ctype==TLS_APPDATA or ctype==TLS_HEARTBEAT:
+                if end<=dlen:
+                    recs.append((ctype,ver,rlen,None))
+                else:
+                    # no need to buffer what we'll not look at
+                    self.skip=end-dlen
+                    self.skiphdr=(ctype,ver,rlen,None)
+                    return
+            else:
+                if end>dlen:
+                    break
+                body=bytes(data[pos+5:end])
+                if ctype==TLS_CCS:
+                    self.ccs_seen=True
+                elif ctype==TLS_HANDSHAKE and self.ccs_seen:
+                    # encrypted Finished or similar
+                    body=None
+                recs.append((ctype,ver,rlen,body))
+            pos=end
+        if pos<dlen:
+            self.buf=bytearray(data[pos:])
+
+    def _goodhdr(self,data,pos):
+        if len(data)-pos<5:
+            # can't tell yet, optimism is ok
+            return True
+        ctype=data[pos]
+        if ctype<TLS_CCS or ctype>TLS_HEARTBEAT:
+            return False
+        if data[pos+1]!=3:
+            return False
+        rlen=(data[pos+3]<<8)|data[pos+4]
+        return rlen<=TLS_MAX_RECLEN
+
+def _der(buf,pos):
+    '''
+    return (tag,content-start,content-length) for the DER TLV at pos
+    '''
+    tag=buf[pos]
+    l=buf[pos+1]
+    pos+=2
+    if l & 0x80:
+        n=l & 0x7f
+        l=int.from_bytes(buf[pos:pos+n],'big')
+        pos+=n
+    return tag,pos,l
+
+OID_RSA=bytes.fromhex('2a864886f70d010101')
+OID_EC=bytes.fromhex('2a8648ce3d0201')
+
+def cert_keyinfo(body):
+    '''
+    Given the body of a Certificate handshake record, dig out the
+    first certificate's public key and return ('rsa',octets) for an
+    RSA modulus (including any leading zero, as wireshark shows it)
+    or ('ec',octets) for an EC public key or None if we can't tell
+    '''
+    try:
+        # handshake header (4), certificate_list length (3), cert length (3)
+        clen=int.from_bytes(body[7:10],'big')
+        cert=body[10:10+clen]
+        if len(cert)<clen:
+            return None
+        tag,pos,l=_der(cert,0) # Certificate
+        tag,pos,l=_der(cert,pos) # TBSCertificate
+        tag,pos,l=_der(cert,pos)
+        if tag==0xa0:
+            # explicit version, skip it
+            pos+=l
+            tag,pos,l=_der(cert,pos)
+        # skip serial, signature, issuer, validity and subject
+        for i in range(0,4):
+            pos+=l
+            tag,pos,l=_der(cert,pos)
+        pos+=l
+        tag,pos,l=_der(cert,pos) # SubjectPublicKeyInfo
+        tag,apos,alen=_der(cert,pos) # AlgorithmIdentifier
+        tag,opos,olen=_der(cert,apos)
+        oid=bytes(cert[opos:opos+olen])
+        tag,bpos,blen=_der(cert,apos+alen) # BIT STRING
+        if tag!=0x03:
+            return None
+        if oid==OID_RSA:
+            # skip unused bits octet, then SEQUENCE { modulus, exponent }
+            tag,spos,slen=_der(cert,bpos+1)
+            tag,mpos,mlen=_der(cert,spos)
+            return 'rsa',mlen
+        if oid==OID_EC:
+            return 'ec',blen-1
+    except (IndexError,ValueError):
+        pass
+    return None
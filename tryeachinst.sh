@@ -42,8 +42,8 @@ do
         echo "Error - exiting"
         exit 1
     fi
-    mv *inst$inst*.csv inst$inst.midi.csv
-    csvmidi inst$inst.midi.csv >inst$inst.midi
+    # Tls2Music writes the .midi itself now, no need for csvmidi
+    mv *inst$inst*.midi inst$inst.midi
     #if [[ "$inst" == "1" ]]
     #then
         #exit